@@ -0,0 +1,99 @@
+# Standard library imports.
+import sys
+import math
+import logging
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler(sys.stdout)
+#logger.setLevel(logging.DEBUG)
+formatter = logging.Formatter("%(name)s - %(levelname)s - %(message)s")
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+
+# Related third party imports.
+import numpy as np
+
+# Local application/library specific imports.
+
+
+DEFAULT_SAMPLERATE: int = 48000
+DEFAULT_WINDOW_SIZE: int = 2048
+# telephone voice band, most of the speech energy and little keyboard or fan noise
+DEFAULT_BAND_LOW: int = 300
+DEFAULT_BAND_HIGH: int = 3400
+# the band RMS is scaled to the 0 - 100 range of the meter
+DEFAULT_GAIN: float = 1000
+MAX_LEVEL: float = 100
+
+
+class LevelAnalyzer:
+    """Voice level of an audio stream, computed over a sliding window.
+
+    Every block is written into a ring buffer, the level is the RMS of the
+    voice band of the last window_size samples, computed with a Hann windowed
+    real FFT. All arrays are allocated up front, feed() does not allocate any
+    sample buffers, so it is safe to call from the audio callback.
+
+    The ring buffer holds every sample twice, at i and i + window_size, so the
+    newest window is always one contiguous slice and needs no copy.
+    """
+
+    def __init__(self, samplerate: int = DEFAULT_SAMPLERATE, window_size: int = DEFAULT_WINDOW_SIZE,
+            band_low: int = DEFAULT_BAND_LOW, band_high: int = DEFAULT_BAND_HIGH,
+            gain: float = DEFAULT_GAIN):
+        self.samplerate: int = samplerate
+        self.window_size: int = window_size
+        self.gain: float = gain
+        self._buffer: np.ndarray = np.zeros(2 * window_size, dtype=np.float32)
+        self._pos: int = 0
+        self._window: np.ndarray = np.hanning(window_size).astype(np.float32)
+        self._windowed: np.ndarray = np.zeros(window_size, dtype=np.float32)
+        self._spectrum: np.ndarray = np.zeros(window_size // 2 + 1, dtype=np.complex64)
+        resolution: float = samplerate / window_size
+        low: int = max(int(math.ceil(band_low / resolution)), 1)
+        high: int = min(int(band_high / resolution), window_size // 2)
+        self._band: slice = slice(low, high + 1)
+        self._magnitudes: np.ndarray = np.empty(high + 1 - low, dtype=np.float32)
+        # Parseval, one sided spectrum, corrected for the power of the window
+        self._scale: float = 2 / (window_size * float(np.dot(self._window, self._window)))
+        try:
+            np.fft.rfft(self._windowed, out=self._spectrum)
+            self._fft_out: bool = True
+        except TypeError:
+            # numpy < 2.0 can not write the spectrum into an existing array
+            self._fft_out = False
+        self.rms: float = 0
+        self.band_rms: float = 0
+        self.level: float = 0
+
+    def feed(self, samples: np.ndarray) -> float:
+        """Adds a block of mono samples, returns the level of the voice band."""
+        self._write(samples)
+        pos: int = self._pos
+        window = self._buffer[pos:pos + self.window_size]
+        self.rms = math.sqrt(float(np.dot(window, window)) / self.window_size)
+        np.multiply(window, self._window, out=self._windowed)
+        if self._fft_out:
+            spectrum = np.fft.rfft(self._windowed, out=self._spectrum)
+        else:
+            spectrum = np.fft.rfft(self._windowed)
+        magnitudes = np.abs(spectrum[self._band], out=self._magnitudes)
+        self.band_rms = math.sqrt(float(np.dot(magnitudes, magnitudes)) * self._scale)
+        self.level = min(self.band_rms * self.gain, MAX_LEVEL)
+        return self.level
+
+    def _write(self, samples: np.ndarray):
+        window_size: int = self.window_size
+        count: int = len(samples)
+        if count >= window_size:
+            samples = samples[count - window_size:]
+            count = window_size
+        buffer = self._buffer
+        pos: int = self._pos
+        first: int = min(count, window_size - pos)
+        buffer[pos:pos + first] = samples[:first]
+        buffer[pos + window_size:pos + window_size + first] = samples[:first]
+        rest: int = count - first
+        if rest:
+            buffer[:rest] = samples[first:]
+            buffer[window_size:window_size + rest] = samples[first:]
+        self._pos = (pos + count) % window_size
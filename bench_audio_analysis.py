@@ -0,0 +1,62 @@
+# Standard library imports.
+import sys
+import time
+
+# Related third party imports.
+import numpy as np
+
+# Local application/library specific imports.
+from audio_analysis import LevelAnalyzer, DEFAULT_SAMPLERATE
+
+# Microbenchmark for the level analysis of the microphone client.
+#
+#   python bench_audio_analysis.py [seconds_of_audio]
+#
+# Prints the CPU time per audio block at 48 kHz and the share of the block
+# duration it takes, for the LevelAnalyzer and the former broadband norm.
+
+BLOCK_SIZES: tuple = (256, 512, 1024, 2048, 4096)
+
+
+def make_signal(seconds: float, samplerate: int) -> np.ndarray:
+    """Noise with a voice like tone, as recorded by sounddevice."""
+    rng = np.random.default_rng(0)
+    t = np.arange(int(seconds * samplerate)) / samplerate
+    signal = 0.05 * np.sin(2 * np.pi * 220 * t) + 0.01 * rng.standard_normal(len(t))
+    return signal.astype(np.float32).reshape(-1, 1)
+
+
+def bench_analyzer(blocks: list, samplerate: int) -> None:
+    analyzer = LevelAnalyzer(samplerate)
+    for block in blocks:
+        analyzer.feed(block[:, 0])
+
+
+def bench_legacy(blocks: list, samplerate: int) -> None:
+    for block in blocks:
+        np.linalg.norm(block) * 10
+
+
+def run(name: str, func, blocks: list, block_size: int, samplerate: int):
+    start_time = time.process_time()
+    func(blocks, samplerate)
+    elapsed = time.process_time() - start_time
+    per_block = elapsed / len(blocks)
+    block_duration = block_size / samplerate
+    print(f"{name:>14} {block_size:>5} samples {per_block * 1e6:>9.1f} us/block "
+        f"{per_block / block_duration * 100:>7.3f} % of the block duration")
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 60
+    samplerate: int = DEFAULT_SAMPLERATE
+    signal = make_signal(seconds, samplerate)
+    for block_size in BLOCK_SIZES:
+        blocks = [signal[start:start + block_size]
+            for start in range(0, len(signal) - block_size + 1, block_size)]
+        run("LevelAnalyzer", bench_analyzer, blocks, block_size, samplerate)
+        run("legacy norm", bench_legacy, blocks, block_size, samplerate)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+# Standard library imports.
+import sys
+import time
+
+# Related third party imports.
+
+# Local application/library specific imports.
+from protocol import LineReader, RECV_SIZE
+
+# Microbenchmark for the command framing of the control socket.
+#
+#   python bench_protocol.py [max_commands]
+#
+# The data is fed in chunks of RECV_SIZE bytes, like it is received from a socket.
+
+COMMANDS: tuple = (b"talk\r\n", b"state:3\r\n", b"state:12\r\n")
+LEGACY_MAX_COMMANDS: int = 10000
+
+
+def legacy_get_next_command(command_buffer: dict, s, new_data: bytes) -> bytes:
+    """The byte by byte framing App.get_next_command used before, one command per call."""
+    command: bytes = command_buffer.get(s, b"")
+    data: bytes = command + new_data
+    if len(data) == 0:
+        return None
+    last_char: bytes = b""
+    command = b""
+    for i, char in enumerate(data):
+        char = bytes([char])
+        if last_char == b"\r" and char == b"\n":
+            command_buffer[s] = data[i+1:]
+            return command[:-1]
+        command += char
+        last_char = char
+    if command:
+        command_buffer[s] = command_buffer.get(s, b"") + command
+    return None
+
+
+def make_stream(count: int) -> bytes:
+    return b"".join(COMMANDS[i % len(COMMANDS)] for i in range(count))
+
+
+def chunks(data: bytes):
+    for start in range(0, len(data), RECV_SIZE):
+        yield data[start:start + RECV_SIZE]
+
+
+def bench_line_reader(data: bytes) -> int:
+    line_reader = LineReader()
+    count: int = 0
+    for chunk in chunks(data):
+        count += len(line_reader.feed(chunk))
+    return count
+
+
+def bench_legacy(data: bytes) -> int:
+    command_buffer: dict = {}
+    count: int = 0
+    for chunk in chunks(data):
+        command = legacy_get_next_command(command_buffer, None, chunk)
+        # drain the rest of the buffer, one command per call
+        while command is not None:
+            count += 1
+            command = legacy_get_next_command(command_buffer, None, b"")
+    return count
+
+
+def run(name: str, func, data: bytes, count: int):
+    start_time = time.perf_counter()
+    result = func(data)
+    elapsed = time.perf_counter() - start_time
+    assert result == count, f"{name}: expected {count} commands, got {result}"
+    print(f"{name:>12} {count:>9} commands {elapsed * 1000:>10.1f} ms {count / elapsed:>14,.0f} commands/s")
+
+
+def main():
+    max_commands = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    count: int = 1000
+    while count <= max_commands:
+        data = make_stream(count)
+        run("LineReader", bench_line_reader, data, count)
+        if count <= LEGACY_MAX_COMMANDS:
+            run("legacy", bench_legacy, data, count)
+        count *= 10
+
+
+if __name__ == "__main__":
+    main()
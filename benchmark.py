@@ -0,0 +1,171 @@
+# Standard library imports.
+import os
+import sys
+import json
+import time
+import argparse
+import logging
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler(sys.stdout)
+#logger.setLevel(logging.DEBUG)
+formatter = logging.Formatter("%(name)s - %(levelname)s - %(message)s")
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+# Related third party imports.
+
+# Local application/library specific imports.
+from command_trace import read_trace
+from metrics import PHASES
+import pngtuber
+
+# Headless benchmark of the render path, no window or GPU is needed:
+#
+#   python benchmark.py [--frames 1000] [--trace trace.txt] [--render-mode idle]
+#                       [--unpaced] [--json report.json] [--max-p99 20]
+#
+# PNGTuber is started with the SDL dummy video driver, using config.ini and
+# layers.ini of the current folder. Every frame the commands of the trace which
+# are due are applied before the frame is rendered. Without a trace, talk is
+# sent every 100 ms and the state changes every second.
+
+DEFAULT_FRAMES: int = 1000
+PERCENTILES: tuple = (50, 90, 99)
+
+
+def make_default_trace(frames: int, state_count: int) -> list:
+    trace: list = []
+    seconds: float = frames / pngtuber.framerate
+    for tick in range(int(seconds * 10) + 1):
+        trace.append((tick / 10, b"talk"))
+    for second in range(1, int(seconds) + 1):
+        trace.append((float(second), b"state:%d" % (second % state_count)))
+    trace.sort(key=lambda entry: entry[0])
+    return trace
+
+
+def percentile(sorted_values: list, percent: float) -> float:
+    """Nearest rank percentile of an ascending list."""
+    if not sorted_values:
+        return 0
+    rank: int = max(int(round(percent / 100 * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+def get_max_rss() -> int:
+    """Returns the peak resident set size in bytes, 0 if unknown."""
+    if resource is None:
+        return 0
+    max_rss: int = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def run(app: pngtuber.App, trace: list, frames: int, paced: bool) -> dict:
+    frame_interval: float = 1 / pngtuber.framerate
+    frame_times: list = []
+    phase_totals: list = [0.0] * len(PHASES)
+    switch_times: list = []
+    trace_pos: int = 0
+    start_time: float = time.monotonic()
+    for frame in range(frames):
+        trace_time: float = frame * frame_interval
+        if paced:
+            delay = start_time + trace_time - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        while trace_pos < len(trace) and trace[trace_pos][0] <= trace_time:
+            app.add_command(trace[trace_pos][1])
+            trace_pos += 1
+        frame_start: float = time.perf_counter()
+        *phases, state_changed = app.render_frame(time.monotonic())
+        frame_times.append(time.perf_counter() - frame_start)
+        for i, phase_time in enumerate(phases):
+            phase_totals[i] += phase_time
+        if state_changed:
+            switch_times.append(phases[0])
+    elapsed: float = time.monotonic() - start_time
+    frame_times.sort()
+    switch_times.sort()
+    return {
+        "frames": frames,
+        "commands": trace_pos,
+        "elapsed": elapsed,
+        "frame_time": {
+            "mean": sum(frame_times) / len(frame_times),
+            **{f"p{p}": percentile(frame_times, p) for p in PERCENTILES},
+            "max": frame_times[-1],
+        },
+        "phases": {name: total / frames for name, total in zip(PHASES, phase_totals)},
+        "state_switch": {
+            "count": len(switch_times),
+            "mean": sum(switch_times) / len(switch_times) if switch_times else 0,
+            "max": switch_times[-1] if switch_times else 0,
+        },
+    }
+
+
+def print_report(report: dict):
+    ms = lambda seconds: f"{seconds * 1000:.3f} ms"
+    mb = lambda size: f"{size / 1024 / 1024:.1f} MB"
+    print(f"frames: {report['frames']} ({report['render_mode']}, "
+        f"{'paced' if report['paced'] else 'unpaced'}) in {report['elapsed']:.2f} s, "
+        f"{report['commands']} commands")
+    frame_time = report["frame_time"]
+    print("frame time:  " + "  ".join(f"{key} {ms(value)}" for key, value in frame_time.items()))
+    print("per frame:   " + "  ".join(f"{key} {ms(value)}" for key, value in report["phases"].items()))
+    state_switch = report["state_switch"]
+    print(f"state switch: {state_switch['count']} switches, "
+        f"mean {ms(state_switch['mean'])}, max {ms(state_switch['max'])}")
+    memory = report["memory"]
+    print(f"memory:      peak rss {mb(memory['max_rss'])}  states {mb(memory['states'])}  "
+        f"scale cache {mb(memory['scale_cache'])}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless frame time benchmark of PNGTuber.")
+    parser.add_argument("--frames", type=int, default=DEFAULT_FRAMES,
+        help="number of frames to render")
+    parser.add_argument("--trace", help="command trace, <seconds>\\t<command> per line")
+    parser.add_argument("--render-mode", choices=(pngtuber.RENDER_MODE_CONTINUOUS, pngtuber.RENDER_MODE_IDLE),
+        help="overrides render_mode of config.ini")
+    parser.add_argument("--unpaced", action="store_true",
+        help=f"render the frames back to back instead of {pngtuber.framerate} per second")
+    parser.add_argument("--json", help="also write the report to this file")
+    parser.add_argument("--max-p99", type=float,
+        help="exit with status 1 if the 99th percentile frame time exceeds this many ms")
+    args = parser.parse_args()
+
+    # has to be set before pygame is initialised
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    app = pngtuber.App(headless=True, render_mode=args.render_mode)
+    app.start()
+    try:
+        if args.trace:
+            trace = read_trace(args.trace)
+        else:
+            trace = make_default_trace(args.frames, app.get_state_count())
+        report = run(app, trace, args.frames, not args.unpaced)
+        report["render_mode"] = app.render_mode
+        report["paced"] = not args.unpaced
+        report["memory"] = dict(app.get_memory_usage(), max_rss=get_max_rss())
+    finally:
+        app.stop()
+
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as json_fh:
+            json.dump(report, json_fh, indent=2)
+    if args.max_p99 is not None and report["frame_time"]["p99"] * 1000 > args.max_p99:
+        logger.error(f"p99 frame time {report['frame_time']['p99'] * 1000:.3f} ms exceeds {args.max_p99} ms")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
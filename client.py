@@ -0,0 +1,317 @@
+# Standard library imports.
+import sys
+import time
+import socket
+import select
+import itertools
+import threading
+from collections import OrderedDict, deque
+import logging
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler(sys.stdout)
+#logger.setLevel(logging.DEBUG)
+formatter = logging.Formatter("%(name)s - %(levelname)s - %(message)s")
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+
+# Related third party imports.
+
+# Local application/library specific imports.
+from protocol import LineReader, create_connection, get_connection_name, DELIMITER, RECV_SIZE, \
+    TRANSPORT_TCP, TRANSPORT_UDP
+
+CONNECT_TIMEOUT: float = 1.0
+# the reconnect delay doubles after every failed attempt, up to the maximum
+MIN_RECONNECT_DELAY: float = 0.1
+MAX_RECONNECT_DELAY: float = 5.0
+DEFAULT_MAX_QUEUE: int = 256
+# when the queue is full, either the oldest queued or the new command is dropped
+DROP_OLDEST: str = "oldest"
+DROP_NEWEST: str = "newest"
+# only the last queued command of each of these replaces the earlier ones,
+# e.g. a state switch or talk:stop which waits for the connection
+DEFAULT_COALESCE: tuple = (b"state", b"talk", b"level")
+# commands of one write are split into datagrams of at most this size
+MAX_DATAGRAM_SIZE: int = 8192
+
+
+def get_command_name(command: bytes) -> bytes:
+    return command.split(b":", 1)[0]
+
+
+class Client:
+    """Persistent connection to PNGTuber, owned by a background thread.
+
+    send() and send_many() only queue commands and wake the thread up, they
+    never block on the network. The thread connects, reconnects with an
+    exponential backoff when the connection fails, writes everything that is
+    queued at once on a non-blocking socket and reads the replies.
+
+    While the client is not connected, commands wait in the queue. Of the
+    commands named in coalesce only the last one is kept, and when the queue
+    is full the oldest or the new command is dropped, depending on drop.
+
+    on_reply(line) is called with every received line and on_connect() after
+    every established connection, both from the thread of the client.
+    """
+
+    def __init__(self, app_config, on_reply=None, on_connect=None, max_queue: int = DEFAULT_MAX_QUEUE,
+            drop: str = DROP_OLDEST, coalesce: tuple = DEFAULT_COALESCE):
+        self.app_config = app_config
+        self.on_reply = on_reply
+        self.on_connect = on_connect
+        self.max_queue: int = max_queue
+        self.drop: str = drop
+        self.coalesce: frozenset = frozenset(coalesce)
+        self._lock: threading.Lock = threading.Lock()
+        # name of a coalesced command or a unique number: command
+        self._queue: OrderedDict = OrderedDict()
+        self._counter = itertools.count()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self._s: socket.socket = None
+        self._datagram: bool = False
+        self._out: bytearray = bytearray()
+        # commands in _out, they are queued again when the connection is lost
+        # before they are written completely
+        self._pending: deque = deque()
+        # bytes of the first pending command which are written already
+        self._pending_written: int = 0
+        self._line_reader: LineReader = LineReader()
+        self._reconnect_delay: float = MIN_RECONNECT_DELAY
+        self._reconfigure: bool = False
+        self._running: bool = False
+        self._stopping: bool = False
+        self._thread: threading.Thread = None
+        self.connected: bool = False
+        # commands handed to the socket completely
+        self.sent: int = 0
+        self.dropped: int = 0
+        self.coalesced: int = 0
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="Client", daemon=True)
+        self._thread.start()
+
+    def send(self, command):
+        """Queues a command, without the \\r\\n delimiter."""
+        self.send_many((command,))
+
+    def send_many(self, commands):
+        """Queues several commands, they are written together."""
+        with self._lock:
+            for command in commands:
+                self._put(command.encode() if isinstance(command, str) else command)
+        self._wake_up()
+
+    def _put(self, command: bytes):
+        queue: OrderedDict = self._queue
+        name: bytes = get_command_name(command)
+        if name in self.coalesce:
+            if name in queue:
+                # keeps the position, so it is not moved after later commands
+                queue[name] = command
+                self.coalesced += 1
+                return
+            key = name
+        else:
+            key = next(self._counter)
+        if len(queue) >= self.max_queue:
+            self.dropped += 1
+            if self.drop == DROP_NEWEST:
+                return
+            queue.popitem(last=False)
+        queue[key] = command
+
+    def reconfigure(self, app_config):
+        """Connects again, e.g. with a changed transport."""
+        with self._lock:
+            self.app_config = app_config
+            self._reconfigure = True
+        self._wake_up()
+
+    def stop(self, timeout: float = 1.0):
+        """Writes the queued commands, waiting up to timeout for a connection,
+        and closes it."""
+        self._stopping = True
+        self._wake_up()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self._running = False
+        self._wake_up()
+        if self._thread is not None:
+            self._thread.join()
+        self._wake_r.close()
+        self._wake_w.close()
+
+    def _wake_up(self):
+        try:
+            self._wake_w.send(b"\0")
+        except OSError:
+            # a wake up is pending already
+            pass
+
+    def _drain_wake_up(self):
+        try:
+            while self._wake_r.recv(RECV_SIZE):
+                pass
+        except OSError:
+            pass
+
+    def _run(self):
+        next_connect: float = 0
+        while self._running:
+            with self._lock:
+                reconfigure, self._reconfigure = self._reconfigure, False
+                idle: bool = not self._queue and not self._out
+            if reconfigure:
+                self._close()
+                next_connect = 0
+            if self._stopping and idle:
+                break
+            if self._s is None:
+                now: float = time.monotonic()
+                if now >= next_connect:
+                    if self._connect():
+                        continue
+                    next_connect = now + self._reconnect_delay
+                    self._reconnect_delay = min(self._reconnect_delay * 2, MAX_RECONNECT_DELAY)
+                self._wait([self._wake_r], [], next_connect - time.monotonic())
+                self._drain_wake_up()
+                continue
+            self._flush()
+            if self._s is None:
+                continue
+            writers: list = [self._s] if self._out else []
+            # while stopping, check right away whether everything was written
+            timeout: float = 0 if self._stopping and not self._out else None
+            readable: list = self._wait([self._s, self._wake_r], writers, timeout)
+            if self._wake_r in readable:
+                self._drain_wake_up()
+            if self._s in readable:
+                self._read()
+        self._close()
+
+    def _wait(self, readers: list, writers: list, timeout: float) -> list:
+        if timeout is not None and timeout < 0:
+            timeout = 0
+        try:
+            readable, _, _ = select.select(readers, writers, [], timeout)
+        except (OSError, ValueError):
+            return []
+        return readable
+
+    def _connect(self) -> bool:
+        app_config = self.app_config
+        try:
+            s = create_connection(app_config, timeout=CONNECT_TIMEOUT)
+        except OSError as err:
+            logger.debug(f"Could not connect: {err}")
+            return False
+        s.setblocking(False)
+        self._s = s
+        self._datagram = app_config.get("transport", TRANSPORT_TCP) == TRANSPORT_UDP
+        self._line_reader = LineReader(RECV_SIZE)
+        self._reconnect_delay = MIN_RECONNECT_DELAY
+        self.connected = True
+        logger.info(f"Connected to {get_connection_name(app_config)}")
+        if self.on_connect is not None:
+            self.on_connect()
+        return True
+
+    def _close(self):
+        if self._s is not None:
+            self._s.close()
+            self._s = None
+        self._requeue_pending()
+        self._out.clear()
+        self.connected = False
+
+    def _requeue_pending(self):
+        """Queues the commands which were not written completely again, in
+        front of the ones queued in the meantime."""
+        with self._lock:
+            queue: OrderedDict = self._queue
+            for command in reversed(self._pending):
+                name: bytes = get_command_name(command)
+                if name in self.coalesce:
+                    if name in queue:
+                        # replaced by a newer one
+                        self.coalesced += 1
+                        continue
+                    key = name
+                else:
+                    key = next(self._counter)
+                queue[key] = command
+                queue.move_to_end(key, last=False)
+        self._pending.clear()
+        self._pending_written = 0
+
+    def _flush(self):
+        with self._lock:
+            commands: list = list(self._queue.values())
+            self._queue.clear()
+        if commands:
+            if self._datagram:
+                self.sent += len(commands)
+                self._send_datagrams(commands)
+                return
+            self._pending.extend(commands)
+            self._out += b"".join(command + DELIMITER for command in commands)
+        if self._out:
+            try:
+                sent: int = self._s.send(self._out)
+            except BlockingIOError:
+                return
+            except OSError as err:
+                logger.debug(f"Could not send: {err}")
+                self._close()
+                return
+            del self._out[:sent]
+            self._count_written(sent)
+
+    def _count_written(self, written: int):
+        pending: deque = self._pending
+        written += self._pending_written
+        while pending and written >= len(pending[0]) + len(DELIMITER):
+            written -= len(pending.popleft()) + len(DELIMITER)
+            self.sent += 1
+        self._pending_written = written
+
+    def _send_datagrams(self, commands: list):
+        datagram: bytearray = bytearray()
+        for command in commands:
+            if datagram and len(datagram) + len(command) + 2 > MAX_DATAGRAM_SIZE:
+                self._send_datagram(datagram)
+                datagram = bytearray()
+            datagram += command + DELIMITER
+        self._send_datagram(datagram)
+
+    def _send_datagram(self, datagram: bytearray):
+        try:
+            self._s.send(datagram)
+        except BlockingIOError:
+            self.dropped += 1
+        except OSError as err:
+            # e.g. nobody listening on the port
+            logger.debug(f"Could not send: {err}")
+
+    def _read(self):
+        try:
+            data: bytes = self._s.recv(RECV_SIZE)
+        except BlockingIOError:
+            return
+        except OSError as err:
+            logger.debug(f"Could not receive: {err}")
+            if not self._datagram:
+                self._close()
+            return
+        if not data and not self._datagram:
+            logger.info("Connection closed")
+            self._close()
+            return
+        if self.on_reply is not None:
+            for line in self._line_reader.feed(data):
+                self.on_reply(line)
@@ -0,0 +1,76 @@
+# Standard library imports.
+import sys
+import time
+import logging
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler(sys.stdout)
+#logger.setLevel(logging.DEBUG)
+formatter = logging.Formatter("%(name)s - %(levelname)s - %(message)s")
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+
+# Related third party imports.
+
+# Local application/library specific imports.
+
+
+# A trace is a text file with one command per line:
+#
+#   <seconds>\t<command>
+#
+# seconds is the time since the start of the trace, command is sent as it is,
+# without the \r\n delimiter. Empty lines and lines starting with # are ignored.
+
+COMMENT: str = "#"
+SEPARATOR: str = "\t"
+
+
+def parse_trace_line(line: str) -> tuple:
+    """Returns (seconds, command) or None for empty lines and comments."""
+    line = line.rstrip("\r\n")
+    if not line.strip() or line.startswith(COMMENT):
+        return None
+    seconds, command = line.split(SEPARATOR, 1)
+    return float(seconds), command.encode()
+
+
+def read_trace(path: str) -> list:
+    """Returns the (seconds, command) pairs of a trace, ordered by time."""
+    trace: list = []
+    with open(path, encoding="utf-8") as trace_fh:
+        for line_number, line in enumerate(trace_fh, 1):
+            try:
+                entry = parse_trace_line(line)
+            except ValueError:
+                logger.error(f"{path}:{line_number}: expected <seconds>\\t<command>")
+                continue
+            if entry is not None:
+                trace.append(entry)
+    trace.sort(key=lambda entry: entry[0])
+    return trace
+
+
+class TraceWriter:
+    """Records commands with the time they were received.
+
+    The times are taken from time.monotonic() and written relative to the first
+    command. The file is block buffered, so most commands cost no system call.
+    """
+
+    def __init__(self, path: str):
+        self.path: str = path
+        self._trace_fh = open(path, "w", encoding="utf-8", newline="\n")
+        self._trace_fh.write(f"{COMMENT} recorded {time.strftime('%Y-%m-%d %H:%M:%S')}\n")
+        self._start_time: float = None
+        self.count: int = 0
+
+    def write(self, timestamp: float, command: bytes):
+        if self._start_time is None:
+            self._start_time = timestamp
+        self._trace_fh.write(f"{timestamp - self._start_time:.6f}{SEPARATOR}"
+            f"{command.decode(errors='backslashreplace')}\n")
+        self.count += 1
+
+    def close(self):
+        self._trace_fh.close()
+        logger.info(f"Recorded {self.count} commands to {self.path}")
@@ -0,0 +1,132 @@
+# Standard library imports.
+import os
+import sys
+import time
+import threading
+import configparser
+import contextlib
+import logging
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler(sys.stdout)
+#logger.setLevel(logging.DEBUG)
+formatter = logging.Formatter("%(name)s - %(levelname)s - %(message)s")
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+
+# Related third party imports.
+
+# Local application/library specific imports.
+
+
+# seconds without a change before the file is written
+DEFAULT_WRITE_DELAY: float = 0.5
+# seconds a change waits at most, while changes keep coming in
+DEFAULT_MAX_WRITE_DELAY: float = 5.0
+
+
+def get_file_signature(path) -> tuple:
+    """Returns (modification time, size) of a file, None if it is missing."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+class ConfigWriter:
+    """Persists single settings of an ini file from a background thread.
+
+    set() only records the value, the thread writes once no value was set for
+    delay seconds, or max_delay seconds after the first unwritten value, so a
+    burst of changes results in one write. The file is read again before it is
+    written, changes made by hand in the meantime are kept. It is written to a
+    temporary file first and renamed, so it is never seen half written.
+
+    on_write(path, old_signature, new_signature) is called from the thread
+    right before the written file replaces the old one, e.g. so a file watcher
+    does not take the change for an edit.
+    """
+
+    def __init__(self, path: str, delay: float = DEFAULT_WRITE_DELAY,
+            max_delay: float = DEFAULT_MAX_WRITE_DELAY):
+        self.path: str = path
+        self._delay: float = delay
+        self._max_delay: float = max_delay
+        self._condition: threading.Condition = threading.Condition()
+        # (section, key): value
+        self._pending: dict = {}
+        self._first_change: float = None
+        self._last_change: float = None
+        self._running: bool = False
+        self._thread: threading.Thread = None
+        self.on_write = None
+        self.writes: int = 0
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="ConfigWriter", daemon=True)
+        self._thread.start()
+
+    def set(self, section: str, key: str, value: str):
+        """Records a value to be written, can be called from any thread."""
+        with self._condition:
+            now: float = time.monotonic()
+            if not self._pending:
+                self._first_change = now
+            self._last_change = now
+            self._pending[(section, key)] = str(value)
+            self._condition.notify()
+
+    def stop(self):
+        """Writes the pending values and ends the thread."""
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        condition: threading.Condition = self._condition
+        while True:
+            with condition:
+                while self._running:
+                    if self._pending:
+                        due: float = min(self._last_change + self._delay,
+                            self._first_change + self._max_delay)
+                        timeout: float = due - time.monotonic()
+                        if timeout <= 0:
+                            break
+                    else:
+                        timeout = None
+                    condition.wait(timeout)
+                pending, self._pending = self._pending, {}
+                running: bool = self._running
+            if pending:
+                self._write(pending)
+            if not running:
+                return
+
+    def _write(self, pending: dict):
+        config = configparser.ConfigParser()
+        tmp_path: str = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            old_signature: tuple = get_file_signature(self.path)
+            config.read(self.path)
+            for (section, key), value in pending.items():
+                if not config.has_section(section):
+                    config.add_section(section)
+                config[section][key] = value
+            with open(tmp_path, "w") as config_fh:
+                config.write(config_fh)
+                config_fh.flush()
+                os.fsync(config_fh.fileno())
+            if self.on_write is not None:
+                # the rename keeps the modification time and size
+                self.on_write(self.path, old_signature, get_file_signature(tmp_path))
+            os.replace(tmp_path, self.path)
+            self.writes += 1
+            logger.debug(f"Wrote {len(pending)} settings to {self.path}")
+        except (OSError, configparser.Error) as err:
+            logger.error(f"Could not write {self.path}: {err}")
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
@@ -0,0 +1,220 @@
+# Standard library imports.
+import os
+import sys
+import time
+import socket
+import asyncio
+import threading
+from collections import deque
+import logging
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler(sys.stdout)
+#logger.setLevel(logging.DEBUG)
+formatter = logging.Formatter("%(name)s - %(levelname)s - %(message)s")
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+
+# Related third party imports.
+
+# Local application/library specific imports.
+from protocol import LineReader, DELIMITER
+
+
+DEFAULT_BACKLOG: int = 128
+DEFAULT_MAX_QUEUE: int = 1024
+
+
+class ControlProtocol(asyncio.Protocol):
+    """A connection to a controller, the commands are parsed on the server thread."""
+
+    transport = None
+
+    def __init__(self, server):
+        self._server = server
+        self.line_reader: LineReader = LineReader()
+        self.name: str = ""
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.name = str(transport.get_extra_info("peername"))
+        self._server.clients.add(self)
+        logger.info(f"Got connection from {self.name}")
+
+    def data_received(self, data: bytes):
+        for command in self.line_reader.feed(data):
+            if command:
+                self._server.put(self, command)
+
+    def connection_lost(self, exc):
+        self._server.clients.discard(self)
+        logger.info(f"{self.name} closed connection")
+
+    def write(self, data: bytes):
+        if not self.transport.is_closing():
+            self.transport.write(data)
+
+
+class DatagramClient:
+    """The sender of a UDP datagram, replies are sent back to its address."""
+
+    def __init__(self, transport, address):
+        self.transport = transport
+        self.name: str = str(address)
+        self.address = address
+
+    def write(self, data: bytes):
+        if not self.transport.is_closing():
+            self.transport.sendto(data, self.address)
+
+
+class ControlDatagramProtocol(asyncio.DatagramProtocol):
+    """Every datagram holds one or more complete commands."""
+
+    transport = None
+
+    def __init__(self, server):
+        self._server = server
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, address):
+        client = DatagramClient(self.transport, address)
+        for command in data.split(DELIMITER):
+            if command:
+                self._server.put(client, command)
+
+    def error_received(self, exc):
+        logger.debug(f"UDP error: {exc}")
+
+
+class ControlServer:
+    """Accepts controllers on an asyncio event loop running in its own thread.
+
+    Received commands are handed to the render thread through a bounded deque,
+    appending and popping is atomic so the render thread never blocks on, or
+    iterates over, sockets. If the queue is full the oldest command is dropped.
+    """
+
+    def __init__(self, host: str, port: int, wakeup=None, max_queue: int = DEFAULT_MAX_QUEUE,
+            unix_socket: str = None, udp_port: int = None, recorder=None):
+        self._host: str = host
+        self._port: int = port
+        self._unix_socket: str = unix_socket
+        self._udp_port: int = udp_port
+        self._wakeup = wakeup
+        self._wakeup_pending: bool = False
+        # a TraceWriter, written on the server thread only
+        self._recorder = recorder
+        self._loop: asyncio.AbstractEventLoop = None
+        self._thread: threading.Thread = None
+        self._started: threading.Event = threading.Event()
+        self._error: Exception = None
+        self.commands: deque = deque(maxlen=max_queue)
+        self.clients: set = set()
+        self.dropped: int = 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="ControlServer", daemon=True)
+        self._thread.start()
+        self._started.wait()
+        if self._error is not None:
+            raise self._error
+
+    def _run(self):
+        self._loop = loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            servers = loop.run_until_complete(self._start_servers())
+        except OSError as err:
+            self._error = err
+            self._started.set()
+            loop.close()
+            if self._recorder is not None:
+                self._recorder.close()
+            return
+        self._started.set()
+        try:
+            loop.run_forever()
+        finally:
+            for server in servers:
+                server.close()
+            for client in list(self.clients):
+                client.transport.close()
+            loop.run_until_complete(asyncio.sleep(0))
+            loop.close()
+            if self._unix_socket:
+                self._remove_unix_socket()
+            if self._recorder is not None:
+                self._recorder.close()
+
+    def _remove_unix_socket(self):
+        try:
+            os.remove(self._unix_socket)
+        except OSError:
+            pass
+
+    async def _start_servers(self) -> list:
+        loop = asyncio.get_running_loop()
+        servers: list = []
+        server = await loop.create_server(lambda: ControlProtocol(self),
+            self._host, self._port, reuse_address=True, backlog=DEFAULT_BACKLOG)
+        logger.info(f"Listening on {self._host}:{self._port}")
+        servers.append(server)
+        if self._unix_socket:
+            if not hasattr(socket, "AF_UNIX"):
+                logger.error("Unix domain sockets are not supported on this platform")
+            else:
+                # remove the socket file of a previous run
+                self._remove_unix_socket()
+                server = await loop.create_unix_server(lambda: ControlProtocol(self),
+                    self._unix_socket, backlog=DEFAULT_BACKLOG)
+                logger.info(f"Listening on {self._unix_socket}")
+                servers.append(server)
+        if self._udp_port:
+            transport, protocol = await loop.create_datagram_endpoint(
+                lambda: ControlDatagramProtocol(self), local_addr=(self._host, self._udp_port))
+            logger.info(f"Listening on udp://{self._host}:{self._udp_port}")
+            servers.append(transport)
+        return servers
+
+    def stop(self):
+        if self._loop is not None and self._loop.is_running():
+            self._loop.call_soon_threadsafe(self._loop.stop)
+        if self._thread is not None:
+            self._thread.join()
+
+    def put(self, client, command: bytes):
+        """Called on the server thread for every received command."""
+        if self._recorder is not None:
+            self._recorder.write(time.monotonic(), command)
+        commands = self.commands
+        if len(commands) == commands.maxlen:
+            self.dropped += 1
+        commands.append((client, command))
+        if not self._wakeup_pending and self._wakeup is not None:
+            self._wakeup_pending = True
+            self._wakeup()
+
+    def get_commands(self) -> list:
+        """Called on the render thread, returns all queued (client, command) pairs."""
+        self._wakeup_pending = False
+        commands = self.commands
+        result: list = []
+        while commands:
+            result.append(commands.popleft())
+        return result
+
+    def get_client_stats(self) -> list:
+        """Returns (name, buffered bytes, queued commands) of the connected
+        clients, can be called from any thread."""
+        queued: dict = {}
+        # copying the deque and the set is atomic, iterating them is not
+        for client, command in list(self.commands):
+            queued[client] = queued.get(client, 0) + 1
+        return [(client.name, len(client.line_reader), queued.get(client, 0))
+            for client in list(self.clients)]
+
+    def reply(self, client, data: bytes):
+        """Sends data to a client, can be called from any thread."""
+        self._loop.call_soon_threadsafe(client.write, data)
@@ -0,0 +1,213 @@
+# Standard library imports.
+import sys
+import time
+import threading
+from bisect import bisect_left
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import logging
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler(sys.stdout)
+#logger.setLevel(logging.DEBUG)
+formatter = logging.Formatter("%(name)s - %(levelname)s - %(message)s")
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+
+# Related third party imports.
+
+# Local application/library specific imports.
+
+
+PREFIX: str = "pngtuber_"
+DEFAULT_METRICS_HOST: str = "127.0.0.1"
+# upper bounds in seconds, a frame at 60 fps has 16.7 ms
+TIME_BUCKETS: tuple = (0.001, 0.002, 0.004, 0.008, 0.0167, 0.033, 0.066, 0.133, 0.25, 0.5, 1.0)
+# the phases of a frame, in the order App.render_frame() returns their times
+PHASES: tuple = ("commands", "update", "draw", "flip", "prefetch")
+PROMETHEUS_CONTENT_TYPE: str = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Histogram:
+    """Counts observations in fixed buckets, an observation is a bisect and
+    three additions."""
+
+    __slots__ = ("name", "help", "buckets", "counts", "sum", "count")
+
+    def __init__(self, name: str, help: str, buckets: tuple = TIME_BUCKETS):
+        self.name: str = name
+        self.help: str = help
+        self.buckets: tuple = buckets
+        # the last count is for observations above the largest bucket
+        self.counts: list = [0] * (len(buckets) + 1)
+        self.sum: float = 0
+        self.count: int = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q quantile."""
+        if not self.count:
+            return 0
+        rank: float = q * self.count
+        cumulative: int = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return float("inf")
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+        }
+
+    def format_prometheus(self, lines: list):
+        name: str = PREFIX + self.name
+        lines.append(f"# HELP {name} {self.help}")
+        lines.append(f"# TYPE {name} histogram")
+        cumulative: int = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f"{name}_sum {self.sum}")
+        lines.append(f"{name}_count {self.count}")
+
+
+def escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Metrics:
+    """Counters and histograms of the render loop.
+
+    They are only updated by the render thread, formatting reads them from
+    other threads without locking, a scrape might see a frame half counted.
+    """
+
+    def __init__(self):
+        self.start_time: float = time.monotonic()
+        self.frames: int = 0
+        self.missed_frames: int = 0
+        self.commands: int = 0
+        # measured by the render loop once per second
+        self.redraw_rate: float = 0
+        self.wakeup_rate: float = 0
+        self.phase_seconds: list = [0.0] * len(PHASES)
+        self.frame_time: Histogram = Histogram("frame_seconds", "Time spent rendering a frame.")
+        self.state_switch: Histogram = Histogram("state_switch_seconds", "Time spent switching the state.")
+        self.resize: Histogram = Histogram("resize_seconds", "Time spent resizing the window content.")
+
+    def observe_frame(self, phases: tuple, state_changed: bool):
+        """phases holds the seconds spent in each of PHASES."""
+        self.frames += 1
+        phase_seconds: list = self.phase_seconds
+        for i, seconds in enumerate(phases):
+            phase_seconds[i] += seconds
+        self.frame_time.observe(sum(phases))
+        if state_changed:
+            self.state_switch.observe(phases[0])
+
+    def to_dict(self, gauges: dict, clients: list) -> dict:
+        uptime: float = time.monotonic() - self.start_time
+        return {
+            "uptime": uptime,
+            "frames": self.frames,
+            "missed_frames": self.missed_frames,
+            "commands": self.commands,
+            "commands_per_second": self.commands / uptime if uptime else 0,
+            "redraw_rate": self.redraw_rate,
+            "wakeup_rate": self.wakeup_rate,
+            "phase_seconds": dict(zip(PHASES, self.phase_seconds)),
+            "frame_seconds": self.frame_time.to_dict(),
+            "state_switch_seconds": self.state_switch.to_dict(),
+            "resize_seconds": self.resize.to_dict(),
+            **{name: value for name, (help, value) in gauges.items()},
+            "clients": [{"name": name, "buffered_bytes": buffered, "queued_commands": queued}
+                for name, buffered, queued in clients],
+        }
+
+    def format_prometheus(self, gauges: dict, clients: list) -> str:
+        lines: list = []
+
+        def add(name: str, metric_type: str, help: str, value):
+            lines.append(f"# HELP {PREFIX}{name} {help}")
+            lines.append(f"# TYPE {PREFIX}{name} {metric_type}")
+            lines.append(f"{PREFIX}{name} {value}")
+
+        add("uptime_seconds", "gauge", "Seconds since the start.", time.monotonic() - self.start_time)
+        add("frames_total", "counter", "Rendered frames.", self.frames)
+        add("missed_frames_total", "counter", "Frames rendered one or more frame intervals late.",
+            self.missed_frames)
+        add("commands_total", "counter", "Received commands.", self.commands)
+        add("redraw_rate", "gauge", "Frames per second which redrew the window, over the last second.",
+            self.redraw_rate)
+        add("wakeup_rate", "gauge", "Wakeups of the render loop per second, over the last second.",
+            self.wakeup_rate)
+        name: str = PREFIX + "phase_seconds_total"
+        lines.append(f"# HELP {name} Time spent in each phase of the frames.")
+        lines.append(f"# TYPE {name} counter")
+        for phase, seconds in zip(PHASES, self.phase_seconds):
+            lines.append(f'{name}{{phase="{phase}"}} {seconds}')
+        for histogram in (self.frame_time, self.state_switch, self.resize):
+            histogram.format_prometheus(lines)
+        for gauge_name, (help, value) in gauges.items():
+            add(gauge_name, "gauge", help, value)
+        for metric, help, index in (("client_buffered_bytes", "Received bytes of an incomplete command.", 1),
+                ("client_queued_commands", "Commands of a client waiting for the next frame.", 2)):
+            name = PREFIX + metric
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} gauge")
+            for client in clients:
+                lines.append(f'{name}{{client="{escape_label(client[0])}"}} {client[index]}')
+        lines.append("")
+        return "\n".join(lines)
+
+
+class MetricsServer:
+    """Serves the metrics in the Prometheus text format on /metrics.
+
+    The server has its own thread and only does work when it is scraped.
+    """
+
+    def __init__(self, host: str, port: int, get_metrics_text):
+        self._host: str = host
+        self._port: int = port
+        self._get_metrics_text = get_metrics_text
+        self._server: ThreadingHTTPServer = None
+        self._thread: threading.Thread = None
+
+    def start(self):
+        get_metrics_text = self._get_metrics_text
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?", 1)[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body: bytes = get_metrics_text().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", PROMETHEUS_CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+        self._server = ThreadingHTTPServer((self._host, self._port), MetricsHandler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name="MetricsServer", daemon=True)
+        self._thread.start()
+        logger.info(f"Serving metrics on http://{self._host}:{self._port}/metrics")
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
@@ -1,10 +1,11 @@
 # Standard library imports.
 import sys
-import socket
+import time
 import queue
 import configparser
 import threading
 import contextlib
+from collections import deque
 import tkinter as tk
 from tkinter import *
 from tkinter import ttk
@@ -22,9 +23,12 @@ logger.addHandler(handler)
 
 # Related third party imports.
 import sounddevice as sd
-import numpy as np
 
 # Local application/library specific imports.
+from audio_analysis import LevelAnalyzer, DEFAULT_BAND_LOW, DEFAULT_BAND_HIGH
+from protocol import get_connection_name
+from client import Client
+from shared_channel import SharedChannel
 
 # lbl -> label
 # frm -> frame
@@ -41,6 +45,18 @@ GREEN: str = "green"
 DEFAULT_HOST = "localhost"
 DEFAULT_PORT = 8089
 DEFAULT_SENSITIVITY = 20
+# the release threshold is this far below the sensitivity (attack threshold)
+DEFAULT_VAD_RELEASE = 5
+# milliseconds the level has to stay below the release threshold
+DEFAULT_VAD_HANGOVER = 300
+# meter level which opens the mouth completely in level mode
+DEFAULT_LEVEL_MAX = 60
+# a ping is sent along with a talk command at most once per interval
+PING_INTERVAL: float = 1.0
+MAX_PENDING_PINGS: int = 32
+LATENCY_HISTORY: int = 50
+# seconds between attempts to attach to the shared memory of PNGTuber
+ATTACH_INTERVAL: float = 1.0
 
 
 class SettingsWindow(Dialog):
@@ -80,20 +96,258 @@ class SettingsWindow(Dialog):
         return True
 
 
+class VoiceActivityDetector:
+    """Decides whether the speaker is talking, with hysteresis.
+
+    Talking starts as soon as the level rises above the attack threshold and
+    stops once it stayed below the release threshold for the hangover time, so
+    short pauses between words and a level hovering around the threshold do not
+    make the mouth flicker.
+    """
+
+    def __init__(self, sensitivity: float, release: float = DEFAULT_VAD_RELEASE,
+            hangover: int = DEFAULT_VAD_HANGOVER):
+        self.release: float = release
+        self.hangover: float = hangover / 1000
+        self.set_sensitivity(sensitivity)
+        self.talking: bool = False
+        self._quiet_since: float = None
+
+    def set_sensitivity(self, sensitivity: float):
+        self.attack_threshold: float = sensitivity
+        self.release_threshold: float = sensitivity - self.release
+
+    def update(self, level: float, now: float) -> bool:
+        """Returns True if talking started or stopped with this level."""
+        if not self.talking:
+            if level > self.attack_threshold:
+                self.talking = True
+                self._quiet_since = None
+                return True
+            return False
+        if level > self.release_threshold:
+            self._quiet_since = None
+        elif self._quiet_since is None:
+            self._quiet_since = now
+        elif now - self._quiet_since >= self.hangover:
+            self.talking = False
+            self._quiet_since = None
+            return True
+        return False
+
+
+class TalkSender(threading.Thread):
+    """Sends talk:start and talk:stop to PNGTuber from its own thread, woken by
+    the audio callback.
+
+    The callback only hands over the level of the newest block, the voice
+    activity detection happens here and the commands are written by the
+    thread of the client, so the delay between an audio block and the command
+    does not depend on the Tk main loop.
+
+    With send_level, level:<0..1> is sent for every block while talking instead,
+    so PNGTuber can show a mouth frame for the loudness, and level:0 at the end.
+
+    With shared_memory, the talk state and the level are written to the shared
+    memory channel of PNGTuber instead, as long as it reads from it. Otherwise
+    the commands are sent over the connection.
+
+    Along with talk:start a ping is sent at most once per PING_INTERVAL,
+    PNGTuber answers with a pong when it applies the commands. The latency is
+    the age of the audio block when talk:start was sent plus half the round trip
+    time.
+    """
+
+    def __init__(self, app_config, vad: VoiceActivityDetector, send_level: bool = False,
+            level_max: float = DEFAULT_LEVEL_MAX):
+        super().__init__(name="TalkSender", daemon=True)
+        self._condition: threading.Condition = threading.Condition()
+        self._running: bool = True
+        # the client connected, the current talk state has to be sent again
+        self._resend: bool = False
+        self._level: float = None
+        self._block_time: float = 0
+        self._next_ping: float = 0
+        self._ping_seq: int = 0
+        # ping number: (send time, block time), the pongs are handled by the client thread
+        self._pings: dict = {}
+        self.client: Client = Client(app_config, on_reply=self._on_reply, on_connect=self._on_connect)
+        self.shared_memory: str = app_config.get("shared_memory", None)
+        self._channel: SharedChannel = None
+        self._next_attach: float = 0
+        self.vad: VoiceActivityDetector = vad
+        self.send_level: bool = send_level
+        self.level_max: float = level_max
+        self._mouth_level: bytes = None
+        self.latency: float = None
+        self.latencies: deque = deque(maxlen=LATENCY_HISTORY)
+
+    @property
+    def connected(self) -> bool:
+        return self.client.connected
+
+    def put_level(self, level: float, block_time: float):
+        """Called from the audio thread for each block."""
+        with self._condition:
+            self._level = level
+            self._block_time = block_time
+            self._condition.notify()
+
+    def reconnect(self, app_config):
+        # read by the thread of the sender, attaches again on the next block
+        self.shared_memory = app_config.get("shared_memory", None)
+        self._next_attach = 0
+        self.client.reconfigure(app_config)
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        self.join()
+
+    def _on_connect(self):
+        with self._condition:
+            self._resend = True
+            self._condition.notify()
+
+    def run(self):
+        self.client.start()
+        while True:
+            with self._condition:
+                while self._level is None and self._running and not self._resend:
+                    self._condition.wait()
+                if not self._running:
+                    break
+                level, block_time = self._level, self._block_time
+                self._level = None
+                resend, self._resend = self._resend, False
+            channel: SharedChannel = self._get_channel()
+            if resend and channel is None:
+                self._mouth_level = None
+                if self.vad.talking:
+                    self._send_talking(time.monotonic(), self.vad.attack_threshold)
+            if level is not None:
+                changed: bool = self.vad.update(level, block_time)
+                if channel is not None:
+                    if changed or (self.send_level and self.vad.talking):
+                        self._write_channel(channel, block_time, level, changed)
+                elif changed:
+                    self._send_talking(block_time, level)
+                elif self.send_level and self.vad.talking:
+                    self._send_level(level)
+        channel = self._channel
+        if self.vad.talking:
+            if channel is not None and channel.confirmed:
+                channel.write(False, 0.0 if self.send_level else None)
+            else:
+                self.client.send(self._get_stop_command())
+        if channel is not None:
+            channel.close()
+        self.client.stop()
+
+    def _get_channel(self) -> SharedChannel:
+        """Returns the shared memory channel while PNGTuber reads from it, else
+        None. Attaches at most once per ATTACH_INTERVAL."""
+        channel: SharedChannel = self._channel
+        if channel is not None:
+            if not self.shared_memory or not channel.is_renderer_alive():
+                logger.info("Shared memory is not read anymore, sending over the connection")
+                channel.close()
+                self._channel = None
+                # hand the current talk state over to the connection
+                self._mouth_level = None
+                if self.vad.talking:
+                    self._send_talking(time.monotonic(), self.vad.attack_threshold)
+                return None
+            return channel if channel.confirmed else None
+        now = time.monotonic()
+        if not self.shared_memory or now < self._next_attach:
+            return None
+        self._next_attach = now + ATTACH_INTERVAL
+        try:
+            self._channel = SharedChannel.attach(self.shared_memory)
+        except OSError as err:
+            logger.debug(f"Could not attach to shared memory {self.shared_memory}: {err}")
+            return None
+        logger.info(f"Attached to shared memory {self.shared_memory}")
+        # used once PNGTuber is seen reading from it
+        return None
+
+    def _write_channel(self, channel: SharedChannel, block_time: float, level: float, changed: bool):
+        talking: bool = self.vad.talking
+        mouth_level: float = None
+        if self.send_level:
+            mouth_level = min(level / self.level_max, 1.0) if talking else 0.0
+        channel.write(talking, mouth_level)
+        if changed and talking:
+            # there is no pong, PNGTuber reads it with its next frame
+            self.latency = time.monotonic() - block_time
+            self.latencies.append(self.latency)
+
+    def _get_stop_command(self) -> bytes:
+        return b"level:0" if self.send_level else b"talk:stop"
+
+    def _get_level_command(self, level: float) -> bytes:
+        """Returns None if the rounded level did not change since it was sent."""
+        mouth_level: bytes = b"%.2f" % min(level / self.level_max, 1.0)
+        if mouth_level == self._mouth_level:
+            return None
+        self._mouth_level = mouth_level
+        return b"level:" + mouth_level
+
+    def _send_level(self, level: float):
+        command: bytes = self._get_level_command(level)
+        if command is not None:
+            self.client.send(command)
+
+    def _send_talking(self, block_time: float, level: float):
+        if not self.vad.talking:
+            logger.debug("Stop talking")
+            self._mouth_level = None
+            self.client.send(self._get_stop_command())
+            return
+        logger.debug(f"♬ ♪ ٩(ˊᗜˋ*)و")
+        commands: list = []
+        if self.send_level:
+            command: bytes = self._get_level_command(level)
+            if command is not None:
+                commands.append(command)
+        else:
+            commands.append(b"talk:start")
+        now = time.monotonic()
+        # without a connection the ping would measure the time until it is back
+        if self.client.connected and now >= self._next_ping:
+            self._next_ping = now + PING_INTERVAL
+            self._ping_seq += 1
+            if len(self._pings) >= MAX_PENDING_PINGS:
+                # pongs got lost, e.g. a UDP datagram
+                self._pings.clear()
+            self._pings[self._ping_seq] = (now, block_time)
+            commands.append(b"ping:%d" % self._ping_seq)
+        self.client.send_many(commands)
+
+    def _on_reply(self, line: bytes):
+        if not line.startswith(b"pong:"):
+            return
+        now = time.monotonic()
+        try:
+            ping = self._pings.pop(int(line[5:]), None)
+        except ValueError:
+            return
+        if ping is None:
+            return
+        send_time, block_time = ping
+        round_trip_time = now - send_time
+        self.latency = latency = send_time - block_time + round_trip_time / 2
+        self.latencies.append(latency)
+        logger.info(f"Latency: {latency * 1000:.1f} ms "
+            f"(block to send {(send_time - block_time) * 1000:.1f} ms, "
+            f"round trip {round_trip_time * 1000:.1f} ms)")
+
+
 class RecGui(Tk):
 
     stream = None
-    connected: bool = False
-
-    def connect(self):
-        try:
-            self._s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self._s.connect((self._host, self._port))
-            self.connected = True
-            self.cvs_status.itemconfig(self.status, fill='green')
-        except:
-            self.connected = False
-            self.cvs_status.itemconfig(self.status, fill='red')
 
     def load_config(self):
         self._config = config = configparser.ConfigParser()
@@ -115,6 +369,28 @@ class RecGui(Tk):
             self._sensitivity = app_config.getint("scl_microphone_sensitivity", DEFAULT_SENSITIVITY)
         except ValueError:
             self._sensitivity = DEFAULT_SENSITIVITY
+        try:
+            self._vad_release = app_config.getfloat("vad_release", DEFAULT_VAD_RELEASE)
+        except ValueError:
+            self._vad_release = DEFAULT_VAD_RELEASE
+        try:
+            self._vad_hangover = app_config.getint("vad_hangover", DEFAULT_VAD_HANGOVER)
+        except ValueError:
+            self._vad_hangover = DEFAULT_VAD_HANGOVER
+        try:
+            self._send_level = app_config.getboolean("send_level", False)
+        except ValueError:
+            self._send_level = False
+        try:
+            self._level_max = app_config.getfloat("level_max", DEFAULT_LEVEL_MAX)
+        except ValueError:
+            self._level_max = DEFAULT_LEVEL_MAX
+        try:
+            self._band_low = app_config.getint("band_low", DEFAULT_BAND_LOW)
+            self._band_high = app_config.getint("band_high", DEFAULT_BAND_HIGH)
+        except ValueError:
+            self._band_low, self._band_high = DEFAULT_BAND_LOW, DEFAULT_BAND_HIGH
+        self._app_config = app_config
 
     def __init__(self):
         super().__init__()
@@ -128,6 +404,8 @@ class RecGui(Tk):
         frm_connection = ttk.Frame(frm_right)
         frm_left = ttk.Frame()
         frm_connection.pack(side=TOP, padx=padding, pady=padding, expand=True)
+        frm_latency = ttk.Frame(frm_right)
+        frm_latency.pack(side=TOP, padx=padding, expand=True)
 
         # vvvv - connection informations
         self.cvs_status = Canvas(frm_connection, width=20, height=20)
@@ -135,9 +413,13 @@ class RecGui(Tk):
         self.status = self.cvs_status.create_oval(1, 1, 19, 19, fill="red", tags="status")
 
         self.lbl_connection = ttk.Label(frm_connection)
-        self.lbl_connection['text'] = f"{self._host}:{self._port}"
+        self.lbl_connection['text'] = get_connection_name(self._app_config)
         self.lbl_connection.pack(side=RIGHT, fill=X, expand=FALSE)
         # ^^^^
+        # vvvv - latency from audio block to talk receipt
+        self.lbl_latency = ttk.Label(frm_latency, text="latency: -")
+        self.lbl_latency.pack(side=TOP)
+        # ^^^^
         
         # vvvvvv - buttons
         # vvvv - settings button
@@ -188,6 +470,11 @@ class RecGui(Tk):
 
         self.metering_q = queue.Queue(maxsize=1)
 
+        self.vad = VoiceActivityDetector(self._sensitivity, self._vad_release, self._vad_hangover)
+        self.talk_sender = TalkSender(self._app_config, self.vad, self._send_level, self._level_max)
+        self.sensitivity.trace_add("write", self.on_sensitivity)
+        self.talk_sender.start()
+
         # We try to open a stream with default settings first, if that doesn't
         # work, the user can manually change the device(s)
         self.create_stream()
@@ -199,12 +486,17 @@ class RecGui(Tk):
         if self.stream is not None:
             self.stream.stop()
         self.stream = sd.InputStream(
-            device=device, channels=1, callback=self.audio_callback)
+            device=device, channels=1, dtype='float32', callback=self.audio_callback)
+        self.analyzer = LevelAnalyzer(int(self.stream.samplerate),
+            band_low=self._band_low, band_high=self._band_high)
         self.stream.start()
 
-    def audio_callback(self, indata, frames, time, status):
+    def audio_callback(self, indata, frames, time_info, status):
         """This is called (from a separate thread) for each audio block."""
-        volume_norm = np.linalg.norm(indata)*10
+        volume_norm = self.analyzer.feed(indata[:, 0])
+        # the first sample of the block was captured this long ago
+        block_age = max(time_info.currentTime - time_info.inputBufferAdcTime, 0)
+        self.talk_sender.put_level(volume_norm, time.monotonic() - block_age)
         try:
             self.metering_q.put_nowait(volume_norm)
         except queue.Full:
@@ -216,23 +508,38 @@ class RecGui(Tk):
             self.create_stream(device=w.result)
 
     def on_save(self, *args):
-        self._config["app"] = {
+        # keep the transport settings
+        self._config["app"] = dict(self._app_config, **{
             "host": self._host,
             "port": self._port,
             "scl_microphone_sensitivity": int(self.sensitivity.get()),
-        }
+        })
         with open('microphone.ini', 'w') as configfile:
             self._config.write(configfile)
 
     def on_reload(self, *args):
-        self._s.close()
         self.load_config()
-        self.lbl_connection['text'] = f"{self._host}:{self._port}"
+        self.vad.release = self._vad_release
+        self.vad.hangover = self._vad_hangover / 1000
+        self.talk_sender.send_level = self._send_level
+        self.talk_sender.level_max = self._level_max
+        self.analyzer = LevelAnalyzer(int(self.stream.samplerate),
+            band_low=self._band_low, band_high=self._band_high)
+        self.talk_sender.reconnect(self._app_config)
+        self.lbl_connection['text'] = get_connection_name(self._app_config)
         self.sensitivity.set(self._sensitivity)
 
+    def on_sensitivity(self, *args):
+        self.vad.set_sensitivity(self.sensitivity.get())
+
     def update_gui(self):
-        if not self.connected:
-            self.connect()
+        """Only displays the meter, talk is sent by the TalkSender."""
+        self.cvs_status.itemconfig(self.status,
+            fill='green' if self.talk_sender.connected else 'red')
+        if self.talk_sender.latencies:
+            latencies = self.talk_sender.latencies
+            self.lbl_latency['text'] = (f"latency: {self.talk_sender.latency * 1000:.0f} ms "
+                f"(avg {sum(latencies) / len(latencies) * 1000:.0f} ms)")
         try:
             volume_norm = self.metering_q.get_nowait()
         except queue.Empty:
@@ -240,26 +547,19 @@ class RecGui(Tk):
         else:
             self.pbr_meter['value'] = volume_norm
             self.pbr_meter.step(volume_norm)
-            s = self.sensitivity.get()
             logger.debug(f"{volume_norm:.2f} > {self.sensitivity.get()}")
-            if volume_norm > s:
-                #logger.debug(f"Microphone Volume: {volume_norm:.2f}")
-                logger.debug(f"♬ ♪ ٩(ˊᗜˋ*)و")
-                if self.connected:
-                    try:
-                        self._s.send(b"talk\r\n")
-                    except:
-                        self.connected = False
-            if volume_norm < (s + 5) and volume_norm > (s - 5):
-                self.pbr_meter['style'] = "yellow.Vertical.TProgressbar"
-            elif volume_norm > s:
+            if self.vad.talking:
                 self.pbr_meter['style'] = "green.Vertical.TProgressbar"
+            elif volume_norm > self.vad.release_threshold:
+                self.pbr_meter['style'] = "yellow.Vertical.TProgressbar"
             else:
                 self.pbr_meter['style'] = "red.Vertical.TProgressbar"
         self.after(100, self.update_gui)
 
     def close_window(self):
-        self._s.close()
+        if self.stream is not None:
+            self.stream.stop()
+        self.talk_sender.stop()
         self.destroy()
 
 
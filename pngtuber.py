@@ -1,11 +1,13 @@
 # Standard library imports.
 import time
 import random
-import socket
-import select
-import random
+import math
 import os
 import sys
+import mmap
+import struct
+import hashlib
+import json
 import logging
 logger = logging.getLogger(__name__)
 handler = logging.StreamHandler(sys.stdout)
@@ -16,8 +18,17 @@ handler.setFormatter(formatter)
 logger.addHandler(handler)
 
 import traceback
+import threading
+import contextlib
+
+import heapq
+import itertools
+import copy
 
 from enum import Enum
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import weakref
 import configparser
 
 # Related third party imports.
@@ -30,6 +41,12 @@ except ModuleNotFoundError:
     animated_images_supported: bool = False
 
 # Local application/library specific imports.
+from control_server import ControlServer
+from command_trace import TraceWriter
+from config_writer import ConfigWriter, get_file_signature
+from metrics import Metrics, MetricsServer, DEFAULT_METRICS_HOST
+from profiler import Profiler, MODE_DETERMINISTIC, MODE_SAMPLING
+from shared_channel import SharedChannel
 
 
 DEFAULT_CAPTION: str = "PNGTuber"
@@ -46,41 +63,759 @@ class Eyes(Enum):
     CLOSED = 2
 
 
+# offset of the eyes in the images of a mouth frame
+EYES_INDEX: dict = {Eyes.OPEN: 0, Eyes.CLOSED: 1}
+# resolution of the level command
+LEVEL_STEPS: int = 100
+
+
 class Mouth(Enum):
     OPEN = 1
     CLOSED = 2
 
 
 class StateGroup(pg.sprite.Group):
+    """The layers and the PNGTuberState of a state, drawn in order.
+
+    Consecutive sprites whose image and position did not change for
+    STATIC_FRAMES frames are flattened into one composite surface, so a frame
+    blits one surface for them instead of one per sprite. The composites are
+    blended with premultiplied alpha, which gives the same result as blitting
+    the sprites one after another, up to rounding.
+    """
+
+    def __init__(self, *sprites):
+        self._drawn: dict = {}
+        # sprite: (image, rect, number of frames it did not change)
+        self._static: dict = {}
+        # ids and positions of a static run: (run, blit sequence entry of its composite)
+        self._composites: OrderedDict = OrderedDict()
+        super().__init__(*sprites)
+
     def talk(self):
         logger.debug("Talking")
         for sprite in self.sprites():
             sprite.talk()
 
+    def set_talking(self, talking: bool):
+        logger.debug(f"Talking: {talking}")
+        for sprite in self.sprites():
+            sprite.set_talking(talking)
+
+    def set_level(self, level: float):
+        for sprite in self.sprites():
+            sprite.set_level(level)
+
     def resize(self, w, h):
         for sprite in self.sprites():
             sprite.resize(w, h)
+        self._composites.clear()
 
+    def refresh_scale(self):
+        """Swaps in the best scaled images that are cached for the current size."""
+        for sprite in self.sprites():
+            sprite.refresh_scale()
+        self._composites.clear()
 
-ANIMATED_FILE_EXT: tuple = (".apng", ".gif")
-IGNORE_RESIZE_REQ_MSG: str = "Ignoring request, size did not change"
+    def activate(self):
+        for sprite in self.sprites():
+            sprite.activate()
+
+    def deactivate(self):
+        for sprite in self.sprites():
+            sprite.deactivate()
+        self._static.clear()
+        self._composites.clear()
+
+    def get_orig_images(self) -> list:
+        orig_images: list = []
+        for sprite in self.sprites():
+            orig_images.extend(sprite.get_orig_images())
+        return orig_images
+
+    def get_images(self) -> list:
+        images: list = []
+        for sprite in self.sprites():
+            images.extend(sprite.get_images())
+        return images
+
+    def get_size_in_bytes(self) -> int:
+        return sum(get_surface_sizes(self.get_images()).values())
+
+    def get_next_update(self) -> float:
+        """Returns the number of seconds until one of the sprites changes, or
+        None if no change is scheduled."""
+        next_update = None
+        for sprite in self.sprites():
+            delay = sprite.get_next_update()
+            if delay is not None and (next_update is None or delay < next_update):
+                next_update = delay
+        return next_update
+
+    def get_blits(self) -> list:
+        """Returns the blit sequence of the current frame, static runs of
+        sprites are replaced by their composite."""
+        static: dict = self._static
+        blits: list = []
+        run: list = []
+        for sprite in self.sprites():
+            image = sprite.image
+            if image is None or sprite.rect is None:
+                continue
+            rect = image.get_rect(topleft=sprite.rect.topleft)
+            last = static.get(sprite)
+            if last is not None and last[0] is image and last[1] == rect:
+                frames: int = last[2] + 1
+            else:
+                frames = 0
+            static[sprite] = (image, rect, frames)
+            if frames >= STATIC_FRAMES and COMPOSITING:
+                run.append((image, rect))
+            else:
+                self._add_run(run, blits)
+                run = []
+                blits.append((image, rect))
+        self._add_run(run, blits)
+        return blits
+
+    def _add_run(self, run: list, blits: list):
+        if len(run) < 2:
+            blits.extend(run)
+            return
+        key: tuple = tuple((id(image), rect.topleft) for image, rect in run)
+        entry: tuple = self._composites.get(key)
+        if entry is None:
+            # the entry keeps the images alive, so their ids are not reused
+            # while it is cached
+            entry = self._composites[key] = (run, composite_surfaces(run))
+            if len(self._composites) > MAX_COMPOSITES:
+                self._composites.popitem(last=False)
+        else:
+            self._composites.move_to_end(key)
+        blits.append(entry[1])
+
+    def draw(self, surface):
+        surface.blits(self.get_blits(), doreturn=False)
+
+    def draw_dirty(self, surface, background_color, full_redraw: bool = False) -> list:
+        """Redraws the area of the sprites whose image or position changed since
+        the last call and returns the dirty rectangles."""
+        drawn: dict = self._drawn
+        frames: list = []
+        dirty_rects: list = []
+        for sprite in self.sprites():
+            image = sprite.image
+            rect = None
+            if image is not None and sprite.rect is not None:
+                rect = image.get_rect(topleft=sprite.rect.topleft)
+                frames.append((image, rect))
+            last_frame = drawn.get(sprite)
+            if last_frame is None or last_frame[0] is not image or last_frame[1] != rect:
+                dirty_rects.extend(r for r in (rect, last_frame and last_frame[1]) if r)
+                drawn[sprite] = (image, rect)
+        if full_redraw:
+            dirty_rects = [surface.get_rect()]
+        if not dirty_rects:
+            return []
+        dirty_rect = dirty_rects[0].unionall(dirty_rects[1:]).clip(surface.get_rect())
+        surface.set_clip(dirty_rect)
+        surface.fill(background_color)
+        surface.blits(self.get_blits(), doreturn=False)
+        surface.set_clip(None)
+        return [dirty_rect]
 
 
-def scale(img, dimension):
-    if isinstance(img, gif_pg.GIFPygame):
+ANIMATED_FILE_EXT: tuple = (".apng", ".gif")
+IGNORE_RESIZE_REQ_MSG: str = "Ignoring request, size did not change"
+SCALE_MODE: str = "scale"
+SMOOTH_SCALE_MODE: str = "smoothscale"
+DEFAULT_SCALE_CACHE_SIZE: int = 256 # in MB
+DEFAULT_MEMORY_BUDGET: int = 0 # in MB, 0 means unlimited
+DEFAULT_CACHE_DIR: str = ".cache"
+DEFAULT_DISK_CACHE_SIZE: int = 1024 # in MB
+RENDER_MODE_CONTINUOUS: str = "continuous"
+RENDER_MODE_IDLE: str = "idle"
+MAX_IDLE_WAIT: float = 0.5 # in seconds, prefetching is checked at least this often
+COMMAND_EVENT: int = pg.event.custom_type()
+# posted by the file watcher when config.ini, layers.ini or an image changed
+RELOAD_EVENT: int = pg.event.custom_type()
+WATCH_INTERVAL: float = 1.0 # in seconds
+# raised by loading a state with a missing layer, image or broken image file,
+# e.g. while config.ini is edited with the app running
+STATE_LOAD_ERRORS: tuple = (KeyError, ValueError, OSError, pg.error)
+# frames a sprite has to stay unchanged before it is composited with its neighbours
+STATIC_FRAMES: int = 30
+# composites kept per state, e.g. for the eye and mouth images of a PNGTuberState
+MAX_COMPOSITES: int = 8
+# premul_alpha was added in pygame 2.1.4
+COMPOSITING: bool = hasattr(pg.Surface, "premul_alpha")
+
+
+def str_to_bool(value) -> bool:
+    return str(value).lower() in ("1", "yes", "true", "on")
+
+
+def is_animated(img) -> bool:
+    return animated_images_supported and isinstance(img, gif_pg.GIFPygame)
+
+
+def scale(img, dimension, mode: str = SCALE_MODE):
+    """Scales with nearest neighbour, or with smoothscale which needs 24 or 32
+    bit surfaces and is several times slower."""
+    smooth: bool = mode == SMOOTH_SCALE_MODE
+    if is_animated(img):
         scaled_image = img.copy()
-        gif_pg.transform.scale(scaled_image, dimension)
+        if smooth:
+            gif_pg.transform.smoothscale(scaled_image, dimension)
+        else:
+            gif_pg.transform.scale(scaled_image, dimension)
+    elif smooth:
+        scaled_image = pg.transform.smoothscale(img, dimension)
     else:
         scaled_image = pg.transform.scale(img, dimension)
     return scaled_image
 
 
+def get_player(image):
+    """Returns an animated image with its own frame, loop and pause state which
+    shares the frames with image. Images are shared by path and size, so every
+    sprite plays its own. Still images are returned as they are."""
+    if not is_animated(image):
+        return image
+    player = copy.copy(image)
+    # the loop counter is changed in place
+    player._loops = list(image._loops)
+    return player
+
+
+def get_scaled_size(size, w, h) -> tuple:
+    iw, ih = size
+    rw = w / iw
+    rh = h / ih
+    ratio = rw if rw < rh else rh
+    return (int(iw*ratio), int(ih*ratio))
+
+
+def decode_image(image_path, loops=-1):
+    """Decodes an image without converting it, thus it can be called from any thread."""
+    if animated_images_supported and image_path.lower().endswith(ANIMATED_FILE_EXT):
+        return gif_pg.load(image_path, loops)
+    return pg.image.load(image_path)
+
+
+def get_surfaces(img) -> list:
+    if is_animated(img):
+        return img.get_surfaces()
+    return [img]
+
+
+def get_image_size_in_bytes(img) -> int:
+    return sum(surface.get_pitch() * surface.get_height() for surface in get_surfaces(img))
+
+
+def get_surface_sizes(images, sizes: dict = None) -> dict:
+    """Adds id: size in bytes of the surfaces of the images to sizes. A surface
+    used by several images, e.g. the same file for every mouth frame or an
+    animated image and its players, is contained once."""
+    if sizes is None:
+        sizes = {}
+    for image in images:
+        for surface in get_surfaces(image):
+            sizes[id(surface)] = surface.get_pitch() * surface.get_height()
+    return sizes
+
+
+class ScaledSurfaceCache:
+    """LRU cache for scaled images, keyed by (image, size, scale mode)."""
+
+    def __init__(self, max_size: int = DEFAULT_SCALE_CACHE_SIZE * 1024 * 1024):
+        self._entries: OrderedDict = OrderedDict()
+        self.max_size: int = max_size
+        self.size: int = 0
+        self.hits: int = 0
+        self.misses: int = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __str__(self) -> str:
+        return (f"{len(self._entries)} entries, {self.size / (1024 * 1024):.1f} MB of "
+            f"{self.max_size / (1024 * 1024):.1f} MB, {self.hits} hits, {self.misses} misses")
+
+    def __contains__(self, key) -> bool:
+        """(image, dimension, mode) in cache, without counting a hit or miss."""
+        return key in self._entries
+
+    def get(self, image, dimension, mode: str = SCALE_MODE):
+        """Returns the cached scaled image or None, without scaling."""
+        key = (image, tuple(dimension), mode)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def scale(self, image, dimension, mode: str = SCALE_MODE):
+        scaled_image = self.get(image, dimension, mode)
+        if scaled_image is not None:
+            return scaled_image
+        self.misses += 1
+        scaled_image = scale(image, dimension, mode)
+        self.put((image, tuple(dimension), mode), scaled_image)
+        return scaled_image
+
+    def put(self, key, scaled_image):
+        size = get_image_size_in_bytes(scaled_image)
+        if size > self.max_size:
+            return
+        old_entry = self._entries.pop(key, None)
+        if old_entry is not None:
+            self.size -= old_entry[1]
+        self._entries[key] = (scaled_image, size)
+        self.size += size
+        while self.size > self.max_size:
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self.size -= evicted_size
+
+    def discard(self, image):
+        """Removes all scaled versions of *image* from the cache."""
+        for key in [key for key in self._entries if key[0] is image]:
+            self.size -= self._entries.pop(key)[1]
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+
+scaled_surface_cache: ScaledSurfaceCache = ScaledSurfaceCache()
+
+
+class DiskImageCache:
+    """Content addressed on-disk cache of decoded and scaled images. Entries are
+    stored as raw RGBA pixels and memory-mapped when they are loaded."""
+
+    VERSION: int = 1
+    MAGIC: bytes = b"PNGT"
+    HEADER = struct.Struct("<4sHHIII") # magic, version, animated, width, height, frames
+
+    def __init__(self, cache_dir: str = DEFAULT_CACHE_DIR, max_size: int = DEFAULT_DISK_CACHE_SIZE * 1024 * 1024):
+        self.cache_dir: str = cache_dir
+        self.max_size: int = max_size
+        self.enabled: bool = True
+
+    @staticmethod
+    def get_file_hash(file_path) -> str:
+        file_hash = hashlib.blake2b(digest_size=20)
+        with open(file_path, "rb") as fh:
+            for chunk in iter(lambda: fh.read(1024 * 1024), b""):
+                file_hash.update(chunk)
+        return file_hash.hexdigest()
+
+    def get_entry_path(self, file_hash, dimension=None, mode=SCALE_MODE) -> str:
+        if dimension is None:
+            size = "orig"
+        else:
+            size = f"{dimension[0]}x{dimension[1]}-{mode}"
+        return os.path.join(self.cache_dir, f"{file_hash}-{size}.v{self.VERSION}")
+
+    def load(self, file_hash, loops=-1, dimension=None, mode=SCALE_MODE):
+        entry_path = self.get_entry_path(file_hash, dimension, mode)
+        try:
+            with open(entry_path, "rb") as fh:
+                # a private mapping, surfaces created from it are writable
+                # without touching the file
+                buffer = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_COPY)
+            os.utime(entry_path)
+        except (OSError, ValueError):
+            return None
+        header_size = self.HEADER.size
+        try:
+            magic, version, animated, width, height, frame_count = self.HEADER.unpack_from(buffer)
+            durations = struct.unpack_from(f"<{frame_count}d", buffer, header_size)
+        except struct.error:
+            magic = version = None
+        frame_size = width * height * 4 if magic is not None else 0
+        offset = header_size + 8 * frame_count if magic is not None else 0
+        if magic != self.MAGIC or version != self.VERSION or len(buffer) != offset + frame_size * frame_count:
+            logger.warning(f"Ignoring invalid cache entry {entry_path}")
+            return None
+        view = memoryview(buffer)
+        surfaces = []
+        for i in range(frame_count):
+            start = offset + i * frame_size
+            surfaces.append(pg.image.frombuffer(view[start:start + frame_size], (width, height), "RGBA"))
+        if animated:
+            if not animated_images_supported:
+                return None
+            return gif_pg.GIFPygame(list(zip(surfaces, durations)), loops)
+        return surfaces[0]
+
+    def store(self, file_hash, image, dimension=None, mode=SCALE_MODE):
+        entry_path = self.get_entry_path(file_hash, dimension, mode)
+        surfaces = get_surfaces(image)
+        durations = image.get_durations() if is_animated(image) else [0]
+        width, height = surfaces[0].get_size()
+        tmp_path = f"{entry_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(tmp_path, "wb") as fh:
+                fh.write(self.HEADER.pack(self.MAGIC, self.VERSION, int(is_animated(image)),
+                    width, height, len(surfaces)))
+                fh.write(struct.pack(f"<{len(durations)}d", *durations))
+                for surface in surfaces:
+                    fh.write(pg.image.tobytes(surface, "RGBA"))
+            os.replace(tmp_path, entry_path)
+        except OSError as err:
+            logger.warning(f"Could not write cache entry {entry_path}: {err}")
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
+
+    def prune(self):
+        """Removes the least recently used entries until the cache fits into max_size."""
+        try:
+            entries = [entry for entry in os.scandir(self.cache_dir) if entry.is_file()]
+        except OSError:
+            return
+        entries = [(entry.stat().st_mtime, entry.stat().st_size, entry.path) for entry in entries]
+        size = sum(entry[1] for entry in entries)
+        for mtime, entry_size, entry_path in sorted(entries):
+            if size <= self.max_size:
+                break
+            with contextlib.suppress(OSError):
+                os.remove(entry_path)
+                size -= entry_size
+
+
+disk_image_cache: DiskImageCache = DiskImageCache()
+
+
+# decoding and scaling on the pool, waiting for it and convert_alpha() in load()
+ASSET_PHASES: tuple = ("decode", "scale", "wait", "convert")
+
+
+class AssetLoader:
+    """Decodes and pre-scales images on a thread pool. Only the final
+    convert_alpha() is done by the thread calling load()."""
+
+    def __init__(self, max_workers: int = None, disk_cache: DiskImageCache = None):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="AssetLoader")
+        self._pending: dict = {}
+        self._images = weakref.WeakValueDictionary()
+        self.disk_cache: DiskImageCache = disk_cache
+        # image path: seconds of each of ASSET_PHASES when it was loaded last
+        self.timings: dict = {}
+
+    def _decode(self, image_path, loops, dimension):
+        disk_cache = self.disk_cache
+        file_hash = None
+        start_time = time.perf_counter()
+        if disk_cache is not None and disk_cache.enabled:
+            file_hash = disk_cache.get_file_hash(image_path)
+        image = file_hash and disk_cache.load(file_hash, loops)
+        if image is None:
+            image = decode_image(image_path, loops)
+            if file_hash:
+                disk_cache.store(file_hash, image)
+        decode_time = time.perf_counter() - start_time
+        scaled_image = scaled_size = None
+        scale_time = 0
+        if dimension is not None:
+            start_time = time.perf_counter()
+            scaled_size = get_scaled_size(image.get_size(), *dimension)
+            scaled_image = file_hash and disk_cache.load(file_hash, loops, scaled_size, SCALE_MODE)
+            if scaled_image is None:
+                scaled_image = scale(image, scaled_size)
+                if file_hash:
+                    disk_cache.store(file_hash, scaled_image, scaled_size, SCALE_MODE)
+            scale_time = time.perf_counter() - start_time
+        return image, scaled_image, scaled_size, decode_time, scale_time
+
+    def prune_disk_cache(self):
+        if self.disk_cache is not None and self.disk_cache.enabled:
+            self._executor.submit(self.disk_cache.prune)
+
+    def submit(self, image_path, loops=-1, dimension=None):
+        key = (image_path, loops)
+        if key in self._images or key in self._pending:
+            return
+        self._pending[key] = self._executor.submit(self._decode, image_path, loops, dimension)
+
+    def is_ready(self, image_path, loops=-1) -> bool:
+        key = (image_path, loops)
+        if key in self._images:
+            return True
+        future = self._pending.get(key)
+        return future is not None and future.done()
+
+    def load(self, image_path, loops=-1, dimension=None):
+        key = (image_path, loops)
+        image = self._images.get(key)
+        if image is not None:
+            return image
+        self.submit(image_path, loops, dimension)
+        future = self._pending.pop(key)
+        start_time = time.perf_counter()
+        image, scaled_image, scaled_size, decode_time, scale_time = future.result()
+        wait_time = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        image = image.convert_alpha()
+        if scaled_image is not None:
+            scaled_surface_cache.put((image, scaled_size, SCALE_MODE), scaled_image.convert_alpha())
+        convert_time = time.perf_counter() - start_time
+        self.timings[image_path] = timing = (decode_time, scale_time, wait_time, convert_time)
+        logger.info(f"Loaded {image_path}: " + ", ".join(f"{name} {value * 1000:.1f} ms"
+            for name, value in zip(ASSET_PHASES, timing)))
+        self._images[key] = image
+        return image
+
+    def get_report(self, slowest: int = 5) -> dict:
+        """Returns the number of loaded images, the seconds spent in each of
+        ASSET_PHASES and the images which took longest."""
+        timings: dict = self.timings
+        by_time: list = sorted(timings.items(), key=lambda item: sum(item[1]), reverse=True)
+        return {
+            "images": len(timings),
+            "seconds": {phase: sum(timing[i] for timing in timings.values())
+                for i, phase in enumerate(ASSET_PHASES)},
+            "slowest": [dict(path=image_path, **dict(zip(ASSET_PHASES, timing)))
+                for image_path, timing in by_time[:slowest]],
+        }
+
+    def forget(self, image_path):
+        """Makes the next load() of image_path decode the file again."""
+        for key in [key for key in self._pending if key[0] == image_path]:
+            self._pending.pop(key).cancel()
+        for key in [key for key in self._images.keys() if key[0] == image_path]:
+            self._images.pop(key, None)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+asset_loader: AssetLoader = AssetLoader(disk_cache=disk_image_cache)
+
+
+class SmoothScaler:
+    """Smoothscales images on a background thread, while the sprites show the
+    nearest neighbour scaled images as placeholders.
+
+    Every request starts a new generation. A running job stops before its next
+    image once a newer request was made and the results of old generations are
+    dropped, so only the last of a burst of resize events is finished. The
+    results are put into the scaled surface cache by the render thread in
+    collect(), all at once.
+    """
+
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="SmoothScaler")
+        self._generation: int = 0
+        self._future = None
+        self.enabled: bool = True
+        # called by the worker thread when a job is done
+        self.on_done = None
+
+    def request(self, images: list, w: int, h: int):
+        """Smoothscales the images to fit into w x h, skipping the cached ones."""
+        self._generation += 1
+        if self._future is not None:
+            self._future.cancel()
+            self._future = None
+        if not self.enabled:
+            return
+        jobs: list = []
+        for image in images:
+            dimension: tuple = get_scaled_size(image.get_size(), w, h)
+            if (image, dimension, SMOOTH_SCALE_MODE) not in scaled_surface_cache:
+                jobs.append((image, dimension))
+        if jobs:
+            self._future = self._executor.submit(self._run, self._generation, jobs)
+
+    def _run(self, generation: int, jobs: list) -> tuple:
+        results: list = []
+        for image, dimension in jobs:
+            if generation != self._generation:
+                return generation, None
+            results.append(((image, dimension, SMOOTH_SCALE_MODE), scale(image, dimension, SMOOTH_SCALE_MODE)))
+        if self.on_done is not None:
+            self.on_done()
+        return generation, results
+
+    @property
+    def ready(self) -> bool:
+        return self._future is not None and self._future.done()
+
+    def collect(self) -> bool:
+        """Puts the images of a finished job into the scaled surface cache,
+        returns True if the sprites should pick them up."""
+        if not self.ready:
+            return False
+        future, self._future = self._future, None
+        try:
+            generation, results = future.result()
+        except Exception:
+            logger.error(traceback.format_exc())
+            return False
+        if generation != self._generation or not results:
+            return False
+        for key, scaled_image in results:
+            scaled_surface_cache.put(key, scaled_image)
+        return True
+
+    def shutdown(self):
+        self._generation += 1
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+smooth_scaler: SmoothScaler = SmoothScaler()
+
+
+def get_scaled_image(image, w, h):
+    """Returns the smoothscaled image if it is cached, the nearest neighbour
+    scaled one otherwise."""
+    dimension: tuple = get_scaled_size(image.get_size(), w, h)
+    if smooth_scaler.enabled:
+        scaled_image = scaled_surface_cache.get(image, dimension, SMOOTH_SCALE_MODE)
+        if scaled_image is not None:
+            return scaled_image
+    return scaled_surface_cache.scale(image, dimension)
+
+
+class Timer:
+    __slots__ = ("deadline", "callback", "cancelled")
+
+    def __init__(self, deadline: float, callback):
+        self.deadline: float = deadline
+        self.callback = callback
+        self.cancelled: bool = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Scheduler:
+    """Heap based timer queue. States and layers register their next deadlines
+    here, so the main loop knows how long it can sleep."""
+
+    def __init__(self):
+        self._timers: list = []
+        self._counter = itertools.count()
+
+    def call_at(self, deadline: float, callback) -> Timer:
+        timer = Timer(deadline, callback)
+        heapq.heappush(self._timers, (deadline, next(self._counter), timer))
+        return timer
+
+    def call_later(self, delay: float, callback) -> Timer:
+        return self.call_at(time.monotonic() + delay, callback)
+
+    def get_next_deadline(self) -> float:
+        timers = self._timers
+        while timers and timers[0][2].cancelled:
+            heapq.heappop(timers)
+        return timers[0][0] if timers else None
+
+    def run_due(self, now: float = None) -> int:
+        if now is None:
+            now = time.monotonic()
+        timers = self._timers
+        count: int = 0
+        while timers and timers[0][0] <= now:
+            timer = heapq.heappop(timers)[2]
+            if not timer.cancelled:
+                timer.callback()
+                count += 1
+        return count
+
+
+scheduler: Scheduler = Scheduler()
+
+
+class FileWatcher:
+    """Polls the modification time of files on a background thread and calls
+    on_change when one of them changed since the last check."""
+
+    def __init__(self, on_change, interval: float = WATCH_INTERVAL):
+        self._on_change = on_change
+        self._interval: float = interval
+        self._paths: tuple = ()
+        self._signatures: dict = {}
+        # path: (signature before, signature after) of a change made by the app
+        self._expected: dict = {}
+        self._stopped: threading.Event = threading.Event()
+        self._thread: threading.Thread = None
+
+    def watch(self, paths):
+        """Replaces the watched files, can be called from any thread."""
+        self._paths = tuple(paths)
+
+    def expect(self, path, old_signature: tuple, new_signature: tuple):
+        """Announces a change made by the app itself, it is not reported if the
+        file was not changed otherwise since the last check. Can be called from
+        any thread."""
+        self._expected[path] = (old_signature, new_signature)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="FileWatcher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        signatures: dict = self._signatures
+        while not self._stopped.wait(self._interval):
+            changed: bool = False
+            for path in self._paths:
+                signature = get_file_signature(path)
+                if path in signatures and signatures[path] != signature:
+                    if self._expected.get(path) == (signatures[path], signature):
+                        logger.debug(f"{path} was written by the app")
+                    else:
+                        logger.info(f"{path} changed")
+                        changed = True
+                signatures[path] = signature
+            if changed:
+                self._on_change()
+
+
+def get_mouth_lut(mouth_frames: int) -> tuple:
+    """Maps level steps to mouth frames, level 0 closes the mouth and the other
+    levels are spread evenly over the open mouth frames."""
+    lut: list = [0]
+    open_frames: int = mouth_frames - 1
+    for step in range(1, LEVEL_STEPS + 1):
+        lut.append(1 + min((step - 1) * open_frames // LEVEL_STEPS, open_frames - 1))
+    return tuple(lut)
+
+
+def composite_surfaces(run: list) -> tuple:
+    """Blends the (image, rect) pairs into one surface with premultiplied alpha
+    and returns its blit sequence entry."""
+    rect = run[0][1].unionall([image_rect for image, image_rect in run[1:]])
+    composite = pg.Surface(rect.size, pg.SRCALPHA)
+    for image, image_rect in run:
+        if image.get_flags() & pg.SRCALPHA:
+            image = image.premul_alpha()
+        composite.blit(image, image_rect.move(-rect.x, -rect.y), special_flags=pg.BLEND_PREMULTIPLIED)
+    return (composite, rect, None, pg.BLEND_PREMULTIPLIED)
+
+
+def get_animation_delay(image) -> float:
+    """Returns the number of seconds until an animated image shows its next frame."""
+    if not is_animated(image) or image.paused or image.ended:
+        return None
+    return max(0, image.frame_time + image.current_duration / image.speed - time.time())
+
+
 class Layer(pg.sprite.Sprite):
 
     rect = None
     _loops: int = -1
     _loop_pause: int | list = None
-    _loop_end_time: float = None
+    _loop_timer: Timer = None
     _loop_pause: int = None
     _random_loop_pause: bool = False
     _is_animated: bool = False
@@ -93,31 +828,21 @@ class Layer(pg.sprite.Sprite):
         self.loop_pause = loop_pause
         self._last_resize_req = (width, height)
         self._image_path = image_path
-        orig_image = self.load_image(image_path)
+        orig_image = self.load_image(image_path, (width, height))
         self._orig_image = orig_image
-        w, h = orig_image.get_size()
-        ratio = self.get_ratio(w, h, width, height)
-        width = int(w*ratio)
-        height = int(h*ratio)
-        self._image = image = scale(orig_image, (width, height))
+        self._scaled_image = self._resize(orig_image, width, height)
+        self._image = image = get_player(self._scaled_image)
         self.rect = image.get_rect()
 
-    def load_image(self, image_path, loop_pause=None):
-        if animated_images_supported:
-            for file_ext in ANIMATED_FILE_EXT:
-                if image_path.lower().endswith(file_ext):
-                    image = gif_pg.load(image_path, self._loops).convert_alpha()
-                    self._is_animated = True
-                    break
-            else:
-                image = pg.image.load(image_path).convert_alpha()
-        else:
-            image = pg.image.load(image_path).convert_alpha()
+    def load_image(self, image_path, dimension=None):
+        image = asset_loader.load(image_path, self._loops, dimension)
+        if is_animated(image):
+            self._is_animated = True
         return image
 
     @property
     def image(self):
-        if isinstance(self._image, gif_pg.GIFPygame):
+        if is_animated(self._image):
             return self._image.blit_ready()
         return self._image
 
@@ -128,11 +853,7 @@ class Layer(pg.sprite.Sprite):
         return ratio
 
     def _resize(self, image, w, h):
-        iw, ih = image.get_size()
-        ratio = self.get_ratio(iw, ih, w, h)
-        width = int(iw*ratio)
-        height = int(ih*ratio)
-        return scale(image, (width, height))
+        return get_scaled_image(image, w, h)
 
     def resize(self, w, h):
         resize_req = (w, h)
@@ -140,23 +861,60 @@ class Layer(pg.sprite.Sprite):
             logger.debug(IGNORE_RESIZE_REQ_MSG)
             return
         self._last_resize_req = resize_req
-        self._image = self._resize(self._orig_image, w, h)
+        self.refresh_scale()
+
+    def refresh_scale(self):
+        scaled_image = self._resize(self._orig_image, *self._last_resize_req)
+        if scaled_image is self._scaled_image:
+            return
+        self._scaled_image = scaled_image
+        image = get_player(scaled_image)
+        if self._is_animated:
+            # both are scaled from the same image, keep the animation where it is
+            image.frame = self._image.frame
+        self._image = image
+
+    def get_orig_images(self) -> list:
+        return [self._orig_image]
+
+    def get_images(self) -> list:
+        return [self._orig_image, self._image]
 
     def talk(self):
         pass
 
+    def set_talking(self, talking: bool):
+        pass
+
+    def set_level(self, level: float):
+        pass
+
+    def activate(self):
+        pass
+
+    def deactivate(self):
+        if self._loop_timer is not None:
+            self._loop_timer.cancel()
+            self._loop_timer = None
+
+    def get_next_update(self) -> float:
+        if self._is_animated and self._image.ended and self._loop_timer is None:
+            return 0
+        return get_animation_delay(self._image)
+
+    def restart_loop(self):
+        self._loop_timer = None
+        self._image.reset()
+        if self._random_loop_pause:
+            self._current_loop_pause = random.randint(*self._loop_pause)
+            logger.debug(f"New loop pause for layer {self._image_path}")
+
     def update(self):
-        if self._is_animated and self._image.ended:
-            if self._loop_end_time is None:
-                self._loop_end_time = time.time()
-            if self._loop_pause is not None and time.time() - self._loop_end_time < self._current_loop_pause:
-                return
+        if self._is_animated and self._image.ended and self._loop_timer is None:
+            if self._loop_pause is None:
+                self.restart_loop()
             else:
-                self._image.reset()
-                self._loop_end_time = None
-                if self._random_loop_pause:
-                    self._current_loop_pause = random.randint(*self._loop_pause)
-                    logger.debug(f"New loop pause for layer {self._image_path}")
+                self._loop_timer = scheduler.call_later(self._current_loop_pause, self.restart_loop)
 
     @property
     def loop_pause(self):
@@ -181,120 +939,455 @@ class PNGTuberState(Layer):
     rect = None
 
     _talk: bool
-    _force_update: bool
     _orig_images: list
     _scaled_images: list
     _current_frame: int
     _last_resize_req: tuple
 
-    def __init__(self, pos, base_dir, eo_mc, ec_mc, eo_mo, ec_mo, width: int, height: int):
+    def __init__(self, pos, base_dir, state_images, width: int, height: int):
+        """state_images holds the eyes open and eyes closed image of every mouth
+        frame, from closed to fully open: eo_mc, ec_mc, ..., eo_mo, ec_mo."""
         pg.sprite.Sprite.__init__(self)
         self._talk: bool = False
-        self._force_update: bool = False
+        # talk:start was received, the mouth stays open until talk:stop
+        self._talk_held: bool = False
         self._orig_images = []
         self._scaled_images = []
         self._current_frame = 0
         self._last_resize_req = (width, height)
-        for state_image in (eo_mc, ec_mc, eo_mo, ec_mo):
+        for state_image in state_images:
             if state_image is None:
                 self._orig_images.append(None)
                 self._scaled_images.append(None)
                 continue
             state_image_path = os.path.join(base_dir, state_image)
-            orig_image = self.load_image(state_image_path)
+            orig_image = self.load_image(state_image_path, (width, height))
             self._orig_images.append(orig_image)
-            scaled_image = self._resize(orig_image, width, height)
+            scaled_image = get_player(self._resize(orig_image, width, height))
             self._scaled_images.append(scaled_image)
+        mouth_frames: int = len(self._orig_images) // 2
+        self._mouth_lut: tuple = get_mouth_lut(mouth_frames)
+        self._open_mouth: int = mouth_frames - 1
+        self._level_mouth: int = 0
         self._image = image = self.get_first_image()
         if image is not None:
             self.rect = image.get_rect()
         #self.rect.center = pos
-        self.time = pg.time.get_ticks()
         self._next_blink: int = random.randint(4000, 6000)
         self._blink_duration: int = 250
         self._talk_cooldown: int = 250
         self._state = Eyes.OPEN
+        self._blink_timer: Timer = None
+        self._talk_timer: Timer = None
+        self.talk_time: float = 0
 
     def get_first_image(self):
         for image in self._scaled_images:
             if image is not None:
                 return image
 
+    def get_orig_images(self) -> list:
+        return [image for image in self._orig_images if image is not None]
+
+    def get_images(self) -> list:
+        return [image for image in self._orig_images + self._scaled_images if image is not None]
+
     def resize(self, w, h):
         resize_req = (w, h)
         if self._last_resize_req == resize_req:
             logger.debug(IGNORE_RESIZE_REQ_MSG)
             return
         self._last_resize_req = resize_req
+        self.refresh_scale()
+
+    def refresh_scale(self):
+        w, h = self._last_resize_req
         self._scaled_images = []
         for orig_image in self._orig_images:
             if orig_image is None:
+                self._scaled_images.append(None)
                 continue
-            self._scaled_images.append(self._resize(orig_image, w, h))
+            self._scaled_images.append(get_player(self._resize(orig_image, w, h)))
+        self.set_image()
+
+    def set_image(self):
+        # eo_mc, ec_mc, ..., eo_mo, ec_mo
+        mouth: int = max(self._level_mouth, self._open_mouth if self._talk else 0)
+        index: int = mouth * 2 + EYES_INDEX[self._state]
+        image = self._scaled_images[index]
+        if image is None:
+            return
+        # Set the image
+        self._image = image
+        # Fetch the rectangle object that has the dimensions of the image
+        self.rect = image.get_rect()
+
+    def activate(self):
+        self.deactivate()
+        self._state = Eyes.OPEN
+        self._blink_timer = scheduler.call_later(self._next_blink / 1000, self.close_eyes)
+        if self._talk and not self._talk_held:
+            self._talk_timer = scheduler.call_at(self.talk_time + self._talk_cooldown / 1000, self.stop_talking)
+        self.set_image()
+
+    def deactivate(self):
+        for timer in (self._blink_timer, self._talk_timer):
+            if timer is not None:
+                timer.cancel()
+        self._blink_timer = self._talk_timer = None
+
+    def close_eyes(self):
+        self._state = Eyes.CLOSED
+        self.set_image()
+        logger.debug("Eyes closed")
+        self._blink_timer = scheduler.call_later(self._blink_duration / 1000, self.open_eyes)
+
+    def open_eyes(self):
+        self._state = Eyes.OPEN
+        self.set_image()
+        logger.debug("Eyes opend")
+        self._next_blink = random.randint(4000, 6000)
+        logger.debug(f"next blink: {self._next_blink}")
+        self._blink_timer = scheduler.call_later(self._next_blink / 1000, self.close_eyes)
+
+    def get_next_update(self) -> float:
+        return get_animation_delay(self._image)
 
     def talk(self):
+        self.talk_time = time.monotonic()
         if not self._talk:
-            self._force_update = True
-        self._talk = True
-        self.talk_time = pg.time.get_ticks()
+            self._talk = True
+            self.set_image()
+        if self._talk_timer is None:
+            self._talk_timer = scheduler.call_at(self.talk_time + self._talk_cooldown / 1000, self.stop_talking)
+
+    def set_talking(self, talking: bool):
+        """Explicit talk start and stop, no cooldown is involved."""
+        if talking == self._talk_held:
+            return
+        self._talk_held = talking
+        if self._talk_timer is not None:
+            self._talk_timer.cancel()
+            self._talk_timer = None
+        if self._talk != talking:
+            self._talk = talking
+            self.set_image()
+
+    def set_level(self, level: float):
+        """Opens the mouth as wide as the level of the voice, 0 to 1."""
+        mouth: int = self._mouth_lut[min(max(int(level * LEVEL_STEPS), 0), LEVEL_STEPS)]
+        if mouth != self._level_mouth:
+            self._level_mouth = mouth
+            self.set_image()
+
+    def stop_talking(self):
+        if self._talk_held:
+            self._talk_timer = None
+            return
+        deadline: float = self.talk_time + self._talk_cooldown / 1000
+        if time.monotonic() < deadline:
+            # talk() was called again in the meantime
+            self._talk_timer = scheduler.call_at(deadline, self.stop_talking)
+            return
+        logger.debug("Stop talking")
+        self._talk_timer = None
+        self._talk = False
+        self.set_image()
 
     def update(self):
-        if self._talk:
-            eo_img = self._scaled_images[2]
-            ec_img = self._scaled_images[3]
-            if pg.time.get_ticks() - self.talk_time >= self._talk_cooldown:
-                logger.debug("Stop talking")
-                self._talk = False
-                self._force_update = True
-                eo_img = self._scaled_images[0]
-                ec_img = self._scaled_images[1]
+        pass
+
+
+class StateDescriptor:
+    """Lightweight description of a state, the images are loaded on first use."""
+
+    group: StateGroup = None
+    # memory of the images when the state was loaded last, kept after unloading
+    # as an estimate for prefetching
+    size: int = 0
+    # compared on reload to find the states which changed
+    signature: tuple = None
+
+    def __init__(self, index: int, name: str, config):
+        self.index: int = index
+        self.name: str = name
+        self.config = config
+
+    @property
+    def loaded(self) -> bool:
+        return self.group is not None
+
+    @property
+    def aliases(self) -> list:
+        aliases: str = self.config.get("aliases", "")
+        return [alias.strip() for alias in aliases.split(",") if alias.strip()]
+
+    def to_dict(self) -> dict:
+        return {"id": self.index, "name": self.name, "aliases": self.aliases}
+
+
+class StateStore:
+    """Loads states on demand and evicts the least recently used ones when the
+    memory budget is exceeded."""
+
+    def __init__(self, load_state, preload_state, memory_budget: int = 0, prefetch: bool = False):
+        self._load_state = load_state
+        self._preload_state = preload_state
+        self._descriptors: list = []
+        # section name or alias: descriptor
+        self._names: dict = {}
+        self._loaded: OrderedDict = OrderedDict()
+        self._prefetch_queue: list = []
+        self.memory_budget: int = memory_budget
+        self.prefetch_enabled: bool = prefetch
+        self.size: int = 0
+
+    def __len__(self) -> int:
+        return len(self._descriptors)
+
+    def __iter__(self):
+        return iter(self._descriptors)
+
+    def __getitem__(self, index: int) -> StateDescriptor:
+        return self._descriptors[index]
+
+    def add(self, name: str, config) -> StateDescriptor:
+        descriptor = StateDescriptor(len(self._descriptors), name, config)
+        self._descriptors.append(descriptor)
+        self._register(descriptor)
+        return descriptor
+
+    def _register(self, descriptor: StateDescriptor):
+        names: dict = self._names
+        # a section name always selects its own state, even if an earlier
+        # state uses it as an alias
+        other: StateDescriptor = names.get(descriptor.name)
+        if other is not None and other is not descriptor:
+            logger.error(f"Alias {descriptor.name} of state {other.name} is the name of a state")
+        names[descriptor.name] = descriptor
+        for alias in descriptor.aliases:
+            other = names.get(alias)
+            if other is not None and other is not descriptor:
+                logger.error(f"{alias} of state {descriptor.name} is already used by state {other.name}")
+                continue
+            names[alias] = descriptor
+
+    def find(self, name: str) -> StateDescriptor:
+        """Returns the state with the section name or alias, or None."""
+        return self._names.get(name)
+
+    def to_list(self) -> list:
+        return [descriptor.to_dict() for descriptor in self._descriptors]
+
+    def _load(self, descriptor: StateDescriptor):
+        logger.info(f"Loading {descriptor.name} ...")
+        descriptor.group = self._load_state(descriptor)
+        descriptor.size = descriptor.group.get_size_in_bytes()
+        self._loaded[descriptor] = None
+        self._update_size()
+
+    def _unload(self, descriptor: StateDescriptor):
+        logger.info(f"Unloading {descriptor.name}, {descriptor.size / (1024 * 1024):.1f} MB")
+        descriptor.group.deactivate()
+        for orig_image in descriptor.group.get_orig_images():
+            scaled_surface_cache.discard(orig_image)
+        del self._loaded[descriptor]
+        descriptor.group = None
+        self._update_size()
+
+    def _update_size(self):
+        """Sums up the memory of the loaded states, images shared between
+        states are counted once."""
+        sizes: dict = {}
+        for descriptor in self._loaded:
+            get_surface_sizes(descriptor.group.get_images(), sizes)
+        self.size = sum(sizes.values())
+
+    def refresh_size(self, keep: StateDescriptor):
+        """Counts the memory again after the images of a loaded state were
+        scaled, and unloads other states if it exceeds the budget now."""
+        self._update_size()
+        self._evict(keep)
+
+    def _evict(self, keep: StateDescriptor):
+        if not self.memory_budget:
+            return
+        for descriptor in list(self._loaded):
+            if self.size <= self.memory_budget:
+                break
+            if descriptor is not keep:
+                self._unload(descriptor)
+
+    def get(self, index: int) -> StateGroup:
+        descriptor = self._descriptors[index]
+        if not descriptor.loaded:
+            self._load(descriptor)
+            self._evict(descriptor)
         else:
-            eo_img = self._scaled_images[0]
-            ec_img = self._scaled_images[1]
-        if self._state == Eyes.OPEN:
-            if self._force_update:
-                if eo_img is None:
-                    return
-                # Set the image
-                self._image = eo_img
-                # Fetch the rectangle object that has the dimensions of the image
-                # Update the position of this object by setting the values of rect.x and rect.y
-                self.rect = eo_img.get_rect()
-                self._force_update = False
-            if pg.time.get_ticks() - self.time >= self._next_blink:
-                if ec_img is None:
-                    return
-                # Set the image
-                self._image = ec_img
-                # Fetch the rectangle object that has the dimensions of the image
-                # Update the position of this object by setting the values of rect.x and rect.y
-                self.rect = ec_img.get_rect()
-                self._next_blink = random.randint(4000, 6000)
-                self.time = pg.time.get_ticks()
-                self._state = Eyes.CLOSED
-                logger.debug("Eyes closed")
-        elif self._state == Eyes.CLOSED:
-            if self._force_update:
-                if ec_img is None:
-                    return
-                # Set the image
-                self._image = ec_img
-                # Fetch the rectangle object that has the dimensions of the image
-                # Update the position of this object by setting the values of rect.x and rect.y
-                self.rect = ec_img.get_rect()
-                self._force_update = False
-            if pg.time.get_ticks() - self.time >= self._blink_duration:
-                if eo_img is None:
-                    return
-                logger.debug(f"next blink: {self._next_blink}")
-                # Set the image
-                self._image = eo_img
-                # Fetch the rectangle object that has the dimensions of the image
-                # Update the position of this object by setting the values of rect.x and rect.y
-                self.rect = eo_img.get_rect()
-                self.time = pg.time.get_ticks()
-                self._state = Eyes.OPEN
-                logger.debug("Eyes opend")
+            self._loaded.move_to_end(descriptor)
+        if self.prefetch_enabled:
+            self._prefetch_queue = [i for i in (index + 1, index - 1) if 0 <= i < len(self._descriptors)]
+        return descriptor.group
+
+    def prefetch(self):
+        """Decodes the states which are likely to be selected next in the
+        background and loads one of them as soon as its images are ready, should
+        be called when there is time left in a frame."""
+        for index in list(self._prefetch_queue):
+            descriptor = self._descriptors[index]
+            if descriptor.loaded:
+                self._prefetch_queue.remove(index)
+                continue
+            if self.memory_budget and self.size >= self.memory_budget:
+                self._prefetch_queue.clear()
+                return
+            if self.memory_budget and self.size + descriptor.size > self.memory_budget:
+                # did not fit the last time it was loaded
+                self._prefetch_queue.remove(index)
+                continue
+            try:
+                if not self._preload_state(descriptor):
+                    continue
+                self._prefetch_queue.remove(index)
+                self._load(descriptor)
+            except STATE_LOAD_ERRORS as err:
+                logger.error(f"Could not prefetch {descriptor.name}: {err!r}")
+                if index in self._prefetch_queue:
+                    self._prefetch_queue.remove(index)
+                continue
+            if self.memory_budget and self.size > self.memory_budget:
+                # prefetching never evicts a state, it only fills unused memory
+                logger.info(f"{descriptor.name} does not fit into the memory budget")
+                self._unload(descriptor)
+                continue
+            # keep the most recently selected states, a prefetched state is the first to go
+            self._loaded.move_to_end(descriptor, last=False)
+            return
+
+    def update(self, states: list) -> list:
+        """Replaces the states by the (name, config, signature) tuples of a
+        reloaded config. States keep their loaded group when their name is
+        still there, removed states are unloaded.
+
+        Returns the loaded states whose signature changed, their groups have
+        to be replaced.
+        """
+        old_descriptors: dict = {descriptor.name: descriptor for descriptor in self._descriptors}
+        self._descriptors = []
+        self._names = {}
+        changed: list = []
+        for index, (name, config, signature) in enumerate(states):
+            descriptor = old_descriptors.pop(name, None)
+            if descriptor is None:
+                descriptor = StateDescriptor(index, name, config)
+            elif descriptor.loaded and descriptor.signature != signature:
+                changed.append(descriptor)
+            descriptor.index = index
+            descriptor.config = config
+            descriptor.signature = signature
+            self._descriptors.append(descriptor)
+            self._register(descriptor)
+        for descriptor in old_descriptors.values():
+            if descriptor.loaded:
+                self._unload(descriptor)
+        self._prefetch_queue = []
+        return changed
+
+    def replace(self, descriptor: StateDescriptor, group: StateGroup) -> StateGroup:
+        """Swaps in the reloaded group of a state and returns the old one."""
+        old_group: StateGroup = descriptor.group
+        old_group.deactivate()
+        kept: set = {id(image) for image in group.get_orig_images()}
+        for orig_image in old_group.get_orig_images():
+            if id(orig_image) not in kept:
+                scaled_surface_cache.discard(orig_image)
+        descriptor.group = group
+        descriptor.size = group.get_size_in_bytes()
+        self._update_size()
+        return old_group
+
+    def preload(self):
+        """Starts decoding the images of all states in the background."""
+        for descriptor in self._descriptors:
+            if not descriptor.loaded:
+                self._preload_state(descriptor)
+
+
+class CommandBatch:
+    """Collects the commands received within one frame. Repeated talk commands
+    collapse into a single cooldown refresh and only the last state command is
+    applied, so the work per frame is bounded no matter how fast clients send."""
+
+    def __init__(self):
+        self.clear()
+
+    def __bool__(self) -> bool:
+        return (self.talk or self.talking is not None or self.level is not None
+            or self.state is not None or bool(self.pings) or bool(self.stats)
+            or bool(self.lists) or bool(self.profile) or self.reload)
+
+    def clear(self):
+        self.talk: bool = False
+        # the last of talk:start and talk:stop wins
+        self.talking: bool = None
+        # only the last level is applied
+        self.level: float = None
+        # index or name of the state
+        self.state: int | str = None
+        # (client, token) pairs, answered with pong once the batch was applied
+        self.pings: list = []
+        # clients which asked for the metrics
+        self.stats: list = []
+        # clients which asked for the list of states
+        self.lists: list = []
+        # profile:start and profile:stop, in the order they were received
+        self.profile: list = []
+        self.reload: bool = False
+        self.count: int = 0
+
+    def add(self, data: bytes, client=None):
+        self.count += 1
+        if data == b"talk":
+            self.talk = True
+            return
+        if data == b"stats":
+            if client is not None:
+                self.stats.append(client)
+            return
+        if data == b"list":
+            if client is not None:
+                self.lists.append(client)
+            return
+        if data == b"reload":
+            self.reload = True
+            return
+        try:
+            cmd, body = data.split(b":", 1)
+            body = body.strip()
+            if cmd == b"state":
+                self.state = int(body) if body.isdigit() else body.decode()
+            elif cmd == b"talk":
+                if body == b"start":
+                    self.talking = True
+                elif body == b"stop":
+                    self.talking = False
+                else:
+                    logger.error(f"Unknown talk event: {body}")
+            elif cmd == b"level":
+                level: float = float(body)
+                if not math.isfinite(level):
+                    raise ValueError(f"Level is not finite: {level}")
+                self.level = min(max(level, 0.0), 1.0)
+            elif cmd == b"profile":
+                self.profile.append(body)
+            elif cmd == b"ping":
+                if client is not None:
+                    self.pings.append((client, body))
+            else:
+                logger.error("Unknown cmd")
+        except ValueError as err:
+            logger.error(err)
+            logger.error(f"data: {data}")
 
 
 class App:
@@ -302,17 +1395,48 @@ class App:
     _port: int
     _s_width: int
     _s_height: int
-
-    def __init__(self):
-        self._command_buffer: dict = {}
-        self.loop()
+    _state_group: StateGroup = None
+    _active_state: StateDescriptor = None
+    _talking: bool = False
+    _level: float = 0
+
+    def __init__(self, headless: bool = False, render_mode: str = None):
+        """Runs the app until the window is closed. In headless mode neither the
+        main loop nor the control server are started, the caller drives the
+        frames with start(), add_command(), render_frame() and stop()."""
+        self._start_time: float = time.perf_counter()
+        self._startup_time: float = 0
+        self._headless: bool = headless
+        self.metrics: Metrics = Metrics()
+        self._metrics_server: MetricsServer = None
+        self._profiler: Profiler = None
+        # overrides render_mode of config.ini
+        self._render_mode_override: str = render_mode
+        self._redraw_count: int = 0
+        self._file_watcher: FileWatcher = None
+        self._config_writer: ConfigWriter = None
+        self._shared_channel: SharedChannel = None
+        # loaded states whose config or images changed, swapped in when decoded
+        self._reloading: list = []
+        if not headless:
+            self.loop()
+
+    def wake_up(self):
+        """Wakes the render loop up, called by the control server thread."""
+        pg.event.post(pg.event.Event(COMMAND_EVENT))
+
+    def request_reload(self):
+        """Called by the file watcher thread."""
+        pg.event.post(pg.event.Event(RELOAD_EVENT))
 
     def connect(self):
-        self._server = server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        server.setblocking(False)
-        server.bind((self._host, self._port))
-        server.listen(5) # become a server socket, maximum 5 connections
+        recorder: TraceWriter = None
+        if self._trace_file:
+            recorder = TraceWriter(self._trace_file)
+            logger.info(f"Recording commands to {self._trace_file}")
+        self._control_server = ControlServer(self._host, self._port, self.wake_up,
+            unix_socket=self._unix_socket, udp_port=self._udp_port, recorder=recorder)
+        self._control_server.start()
 
     def load_config(self):
         self._config = config = configparser.ConfigParser()
@@ -332,31 +1456,60 @@ class App:
         self._background_color: str = app_config.get("background_color", "magenta")
         self._host: str = app_config.get("host", DEFAULT_HOST) 
         self._port: int = int(app_config.get("port", DEFAULT_PORT))
+        self._unix_socket: str = app_config.get("unix_socket", None)
+        udp_port = app_config.get("udp_port", None)
+        self._udp_port: int = int(udp_port) if udp_port else None
+        self._trace_file: str = app_config.get("trace_file", None)
+        self._shared_memory: str = app_config.get("shared_memory", None)
+        metrics_port = app_config.get("metrics_port", None)
+        self._metrics_port: int = int(metrics_port) if metrics_port else None
+        self._metrics_host: str = app_config.get("metrics_host", DEFAULT_METRICS_HOST)
         self._s_width: int = int(app_config.get("width", SCREEN_WIDTH))
         self._s_height: int = int(app_config.get("height", SCREEN_HEIGHT))
+        scale_cache_size: int = int(app_config.get("scale_cache_size", DEFAULT_SCALE_CACHE_SIZE))
+        scaled_surface_cache.max_size = scale_cache_size * 1024 * 1024
+        self._memory_budget: int = int(app_config.get("memory_budget", DEFAULT_MEMORY_BUDGET))
+        self._prefetch: bool = str_to_bool(app_config.get("prefetch", "yes"))
+        self._render_mode: str = app_config.get("render_mode", RENDER_MODE_CONTINUOUS)
+        self._watch_files: bool = str_to_bool(app_config.get("watch_files", "no"))
+        smooth_scaler.enabled = str_to_bool(app_config.get("smooth_scale", "yes"))
+        disk_image_cache.enabled = str_to_bool(app_config.get("disk_cache", "yes"))
+        disk_image_cache.cache_dir = app_config.get("cache_dir", DEFAULT_CACHE_DIR)
+        disk_image_cache.max_size = int(app_config.get("disk_cache_size", DEFAULT_DISK_CACHE_SIZE)) * 1024 * 1024
+        asset_loader.prune_disk_cache()
         self._app_config = app_config
 
-    def save_config(self):
-        with open('config.ini', 'w') as config_fh:
-            self._config.write(config_fh)
+    def save_setting(self, key: str, value):
+        """Changes a setting of the app section, config.ini is written by the
+        config writer thread, never by the render loop."""
+        value = str(value)
+        if self._app_config.get(key) == value:
+            return
+        self._app_config[key] = value
+        if self._config_writer is not None:
+            self._config_writer.set("app", key, value)
+
+    def get_layer_settings(self, layer_name) -> tuple:
+        layer_config = self._layers_config[layer_name]
+        base_dir = layer_config["base_dir"]
+        image = layer_config["image"]
+        loop_pause = layer_config.get("loop_pause", None)
+        if loop_pause is not None:
+            tmp = loop_pause.split("-")
+            if len(tmp) == 1:
+                loop_pause = int(loop_pause)
+            else:
+                loop_pause = [int(value) for value in tmp]
+        loops = int(layer_config.get("loops", -1))
+        image_path = os.path.join(base_dir, image)
+        return image_path, loops, loop_pause
 
-    def load_layers(self, layer_list):
+    def load_layers(self, state_group, layer_list):
         for layer_name in layer_list:
-            layer_config = self._layers_config[layer_name]
-            base_dir = layer_config["base_dir"]
-            image = layer_config["image"]
-            loop_pause = layer_config.get("loop_pause", None)
-            if loop_pause is not None:
-                tmp = loop_pause.split("-")
-                if len(tmp) == 1:
-                    loop_pause = int(loop_pause)
-                else:
-                    loop_pause = [int(value) for value in tmp]
-            loops = int(layer_config.get("loops", -1))
-            image_path = os.path.join(base_dir, image)
+            image_path, loops, loop_pause = self.get_layer_settings(layer_name)
             layer = Layer(image_path, self._s_width, self._s_height, loops, loop_pause)
             logger.info(f"adding layer for image: {image_path}")
-            self._state_group.add(layer)
+            state_group.add(layer)
 
     def _layers_str_to_list(self, layers_str: str) -> list:
         layer_list: list = []
@@ -365,190 +1518,587 @@ class App:
                 layer_list.append(layer_name.strip())
         return layer_list
 
-    def load_states(self):
+    def get_mouth_frames(self, state) -> list:
+        """Returns the images of the mouth frames, alternating eyes open and eyes
+        closed, or None if the state has no eo_mouth list."""
+        eo_mouth: list = self._layers_str_to_list(state.get("eo_mouth", None))
+        if not eo_mouth:
+            return None
+        if len(eo_mouth) < 2:
+            logger.error("eo_mouth needs at least two mouth frames")
+            eo_mouth = eo_mouth * 2
+        ec_mouth: list = self._layers_str_to_list(state.get("ec_mouth", None))
+        if not ec_mouth:
+            # no blinking
+            ec_mouth = eo_mouth
+        elif len(ec_mouth) != len(eo_mouth):
+            logger.error("ec_mouth and eo_mouth need the same number of mouth frames")
+            ec_mouth = (ec_mouth + eo_mouth[len(ec_mouth):])[:len(eo_mouth)]
+        state_images: list = []
+        for eo_image, ec_image in zip(eo_mouth, ec_mouth):
+            state_images.extend((eo_image, ec_image))
+        return state_images
+
+    def get_state_settings(self, state) -> tuple:
+        base_dir = state.get("base_dir", "")
+        state_images: list = self.get_mouth_frames(state)
+        if state_images is None and "image" in state:
+            state_images = [state.get("image", None)] * 4
+        elif state_images is None:
+            # eo_mc, ec_mc, eo_mo, ec_mo
+            state_images = [state.get(key, None) for key in ("eo_mc", "ec_mc", "eo_mo", "ec_mo")]
+        # front layers
+        layer_list: list = self._layers_str_to_list(state.get("layers", None))
+        # back layers
+        layer_back_list: list = self._layers_str_to_list(state.get("layers.back", None))
+        return base_dir, state_images, layer_list, layer_back_list
+
+    def get_state_image_requests(self, state) -> list:
+        """Returns the (image_path, loops) pairs of all images used by a state."""
+        base_dir, state_images, layer_list, layer_back_list = self.get_state_settings(state)
+        image_requests: list = []
+        for state_image in state_images:
+            if state_image is not None:
+                image_requests.append((os.path.join(base_dir, state_image), PNGTuberState._loops))
+        for layer_name in layer_back_list + layer_list:
+            image_path, loops, loop_pause = self.get_layer_settings(layer_name)
+            if loop_pause is not None:
+                loops = 0
+            image_requests.append((image_path, loops))
+        return image_requests
+
+    def preload_state(self, descriptor: StateDescriptor) -> bool:
+        """Submits the images of a state to the asset loader, returns True when
+        all of them are decoded."""
+        dimension: tuple = (self._s_width, self._s_height)
+        ready: bool = True
+        for image_path, loops in self.get_state_image_requests(descriptor.config):
+            asset_loader.submit(image_path, loops, dimension)
+            ready = asset_loader.is_ready(image_path, loops) and ready
+        return ready
+
+    def load_state(self, descriptor: StateDescriptor) -> StateGroup:
+        # decode all images of the state concurrently
+        self.preload_state(descriptor)
+        base_dir, state_images, layer_list, layer_back_list = self.get_state_settings(descriptor.config)
+
+        state_group = StateGroup()
+        self.load_layers(state_group, layer_back_list)
+        png_tuber_state = PNGTuberState((0, 0), base_dir, state_images, self._s_width, self._s_height)
+        #png_tuber_state.resize(self._s_width, self._s_height)
+        state_group.add(png_tuber_state)
+        self.load_layers(state_group, layer_list)
+        return state_group
+
+    def get_state_signature(self, state) -> tuple:
+        """Changes when the section of the state, one of its layer sections or
+        one of its image files changes."""
+        base_dir, state_images, layer_list, layer_back_list = self.get_state_settings(state)
+        layers_config = self._layers_config
+        layers: tuple = tuple((layer_name, tuple(layers_config[layer_name].items())
+            if layers_config.has_section(layer_name) else None)
+            for layer_name in layer_back_list + layer_list)
+        try:
+            image_paths: list = [image_path for image_path, loops in self.get_state_image_requests(state)]
+        except KeyError:
+            # a layer is missing, loading the state will report it
+            image_paths = []
+        files: tuple = tuple((image_path, get_file_signature(image_path)) for image_path in image_paths)
+        # aliases only change the names a state is addressed by
+        items: tuple = tuple(item for item in state.items() if item[0] != "aliases")
+        return (items, layers, files)
+
+    def get_states_config(self) -> list:
+        """Returns (name, config, signature) of every state in config.ini."""
         config = self._config
-        self._states = states = []
-        c_sections = config.sections()
-        for state_name in c_sections:
+        states: list = []
+        for state_name in config.sections():
             if state_name == "app":
                 continue
-            logger.info(f"Loading {state_name} ...")
             state = config[state_name]
-            base_dir = state.get("base_dir", "")
-            if "image" in state:
-                eo_mo = ec_mo = eo_mc = ec_mc = state.get("image", None)
-            else:
-                ec_mc = state.get("ec_mc", None)
-                eo_mc = state.get("eo_mc", None)
-                ec_mo = state.get("ec_mo", None)
-                eo_mo = state.get("eo_mo", None)
-
-            self._state_group = state_group = StateGroup()
-
-            # vvvv - front layers
-            layers: str = state.get("layers", None)
-            layer_list: list = self._layers_str_to_list(layers)
-            # ^^^^
-            # vvvv - back layers
-            layers_back: str = state.get("layers.back", None)
-            layer_back_list: list = self._layers_str_to_list(layers_back)
-            # ^^^^
-            self.load_layers(layer_back_list)
-            png_tuber_state = PNGTuberState((0, 0), base_dir, eo_mc, ec_mc, eo_mo, ec_mo, self._s_width, self._s_height)
-            #png_tuber_state.resize(self._s_width, self._s_height)
-            state_group.add(png_tuber_state)
-            self.load_layers(layer_list)
-            states.append(state_group)
-
-    def get_next_command(self, s) -> bytes:
-        command_buffer = self._command_buffer
-        command: bytes = command_buffer.get(s, b"")
-        new_data: bytes = s.recv(1024)
-        if not new_data:
-            del command_buffer[s]
-            self._socket_list.remove(s)
+            states.append((state_name, state, self.get_state_signature(state)))
+        return states
+
+    def watch_files(self, states: list):
+        if self._file_watcher is None:
+            return
+        paths: list = ['config.ini', 'layers.ini']
+        for state_name, state, (items, layers, files) in states:
+            paths.extend(image_path for image_path, file_signature in files)
+        self._file_watcher.watch(dict.fromkeys(paths))
+
+    def load_states(self):
+        self._states = states = StateStore(self.load_state, self.preload_state,
+            self._memory_budget * 1024 * 1024, self._prefetch)
+        states_config: list = self.get_states_config()
+        for state_name, state, signature in states_config:
+            states.add(state_name, state).signature = signature
+        self.watch_files(states_config)
+        if not self._memory_budget:
+            states.preload()
+
+    def reload(self):
+        """Reads config.ini and layers.ini again. Only the states whose section,
+        layers or image files changed are reloaded, and only the changed image
+        files are decoded again. The images are decoded in the background, the
+        states are swapped in by swap_reloaded_states() when they are ready.
+        The app section is not reloaded."""
+        config = configparser.ConfigParser()
+        layers_config = configparser.ConfigParser()
+        try:
+            config.read('config.ini')
+            layers_config.read('layers.ini')
+        except configparser.Error as err:
+            logger.error(f"Reload failed: {err}")
+            return
+        # keep the app section, it holds the current window size
+        config["app"] = dict(self._app_config)
+        old_signatures: dict = {}
+        for descriptor in self._states:
+            if descriptor.signature is not None:
+                old_signatures.update(descriptor.signature[2])
+        active: StateDescriptor = self._active_state
+        self._config, self._layers_config = config, layers_config
+        self._app_config = config["app"]
+        states_config: list = self.get_states_config()
+        for state_name, state, (items, layers, files) in states_config:
+            for image_path, file_signature in files:
+                if image_path in old_signatures and old_signatures[image_path] != file_signature:
+                    asset_loader.forget(image_path)
+        changed: list = self._states.update(states_config)
+        self._reloading = [descriptor for descriptor in self._reloading
+            if descriptor.loaded and descriptor not in changed] + changed
+        self.watch_files(states_config)
+        logger.info(f"Reloaded config, {len(self._states)} states, "
+            f"{len(changed)} loaded states changed")
+        if active is None or not active.loaded:
+            # the active state was removed
+            try:
+                self.select_state(0)
+            except STATE_LOAD_ERRORS as err:
+                logger.error(f"Could not load {self._states[0].name}: {err!r}")
+
+    def swap_reloaded_states(self):
+        """Swaps in the reloaded states whose images are decoded."""
+        for descriptor in list(self._reloading):
+            if not descriptor.loaded:
+                # unloaded for the memory budget, it is loaded from the new config when selected
+                self._reloading.remove(descriptor)
+                continue
+            try:
+                if not self.preload_state(descriptor):
+                    continue
+                self._reloading.remove(descriptor)
+                state_group: StateGroup = self.load_state(descriptor)
+                old_group: StateGroup = self._states.replace(descriptor, state_group)
+            except STATE_LOAD_ERRORS as err:
+                logger.error(f"Could not reload {descriptor.name}: {err!r}")
+                if descriptor in self._reloading:
+                    self._reloading.remove(descriptor)
+                continue
+            logger.info(f"Reloaded {descriptor.name}")
+            if old_group is self._state_group:
+                self.select_state(descriptor.index)
+                self._full_redraw = True
+
+    def get_state_index(self, state: int | str) -> int:
+        """Returns the index of a state given by index, name or alias, or None."""
+        if isinstance(state, int):
+            if 0 <= state < len(self._states):
+                return state
+            logger.error("State index out of range")
             return None
-        data: bytes = command + new_data
-        if len(data) == 0:
+        descriptor: StateDescriptor = self._states.find(state)
+        if descriptor is None:
+            logger.error(f"Unknown state: {state}")
             return None
-        last_char: bytes = b""
-        command = b""
-        for i, char in enumerate(data):
-            char = bytes([char])
-            if last_char == b"\r" and char == b"\n":
-                command_buffer[s] = data[i+1:]
-                return command[:-1]
-            command += char
-            last_char = char
-        if command:
-            command_buffer[s] = command_buffer.get(s, b"") + command
-        return None
-
-    def loop(self):
+        return descriptor.index
+
+    def get_state_list(self) -> dict:
+        return {"current": self._active_state.name, "states": self._states.to_list()}
+
+    def select_state(self, index: int) -> StateGroup:
+        """Raises one of STATE_LOAD_ERRORS if the state can not be loaded, the
+        current state is kept then."""
+        state_group: StateGroup = self._states.get(index)
+        self._active_state = self._states[index]
+        if state_group is not self._state_group:
+            if self._state_group is not None:
+                self._state_group.deactivate()
+            state_group.activate()
+            state_group.set_talking(self._talking)
+            state_group.set_level(self._level)
+            self._state_group = state_group
+            state_group.resize(self._s_width, self._s_height)
+            self.request_smooth_scale()
+            self.save_setting("last_state", self._active_state.name)
+        else:
+            state_group.resize(self._s_width, self._s_height)
+        logger.debug(f"Scale cache: {scaled_surface_cache}")
+        return state_group
+
+    def request_smooth_scale(self):
+        """Smoothscales the images of the active state in the background, they
+        are swapped in by render_frame() when all of them are done."""
+        smooth_scaler.request(self._state_group.get_orig_images(), self._s_width, self._s_height)
+
+    def apply_commands(self, command_batch: CommandBatch) -> bool:
+        """Applies the commands of one frame, returns True if the state changed."""
+        state_changed: bool = False
+        if command_batch.reload:
+            self.reload()
+            self._full_redraw = True
+        if command_batch.state is not None:
+            index: int = self.get_state_index(command_batch.state)
+            if index is not None:
+                try:
+                    self.select_state(index)
+                    state_changed = True
+                except STATE_LOAD_ERRORS as err:
+                    logger.error(f"Could not load {self._states[index].name}: {err!r}")
+        if command_batch.talking is not None:
+            self._talking = command_batch.talking
+            self._state_group.set_talking(self._talking)
+        if command_batch.level is not None:
+            self._level = command_batch.level
+            self._state_group.set_level(self._level)
+        if command_batch.talk:
+            self._state_group.talk()
+        for client, token in command_batch.pings:
+            self.reply(client, b"pong:" + token + b"\r\n")
+        for action in command_batch.profile:
+            self.handle_profile(action)
+        if command_batch.lists:
+            state_list: bytes = json.dumps(self.get_state_list()).encode()
+            for client in command_batch.lists:
+                self.reply(client, b"list:" + state_list + b"\r\n")
+        if command_batch.stats:
+            stats: bytes = json.dumps(self.get_stats()).encode()
+            for client in command_batch.stats:
+                self.reply(client, b"stats:" + stats + b"\r\n")
+        return state_changed
+
+    def start(self):
+        """Opens the window, or the offscreen surface of the dummy video driver
+        in headless mode, and loads the states."""
         self.load_config()
         self.load_app_config()
 
-        self.connect()
-        server = self._server
-        self._socket_list = socket_list = [server]
-        command_buffer = self._command_buffer
-
         # Initialise pygame
         pg.init()
         pg.display.set_caption(self._app_config.get("caption", DEFAULT_CAPTION))
 
-        screen = pg.display.set_mode([self._s_width, self._s_height], pg.RESIZABLE)
+        self._control_server: ControlServer = None
+        if not self._headless:
+            self.connect()
+            if self._metrics_port:
+                self._metrics_server = MetricsServer(self._metrics_host, self._metrics_port,
+                    self.get_metrics_text)
+                self._metrics_server.start()
+        self._command_batch: CommandBatch = CommandBatch()
+        if not self._headless:
+            smooth_scaler.on_done = self.wake_up
+            self._config_writer = ConfigWriter('config.ini')
+            self._config_writer.start()
+            if self._shared_memory:
+                try:
+                    self._shared_channel = SharedChannel.create(self._shared_memory)
+                except OSError as err:
+                    logger.error(f"Could not create shared memory {self._shared_memory}: {err}")
+            if self._watch_files:
+                self._file_watcher = FileWatcher(self.request_reload)
+                # writing last_state or the window size is not an edit
+                self._config_writer.on_write = self._file_watcher.expect
+
+        self._screen = screen = pg.display.set_mode([self._s_width, self._s_height], pg.RESIZABLE)
         background_color = self._background_color
         logger.debug(f"background_color: {background_color}")
         if background_color.startswith("#"):
             background_color = pg.Color(background_color)
+        self._background_color = background_color
         screen.fill(background_color)
-        s_width, s_height = screen.get_width(), screen.get_height()
-        self._s_width, self._s_height = s_width, s_height
+        self._s_width, self._s_height = screen.get_width(), screen.get_height()
 
         # Create sprites
         self.load_states()
-        states: list = self._states
-        png_tuber_state = states[0]
+        last_state: StateDescriptor = self._states.find(self._app_config.get("last_state", ""))
+        self.select_state(last_state.index if last_state is not None else 0)
+        if self._file_watcher is not None:
+            self._file_watcher.start()
+        self._startup_time = time.perf_counter() - self._start_time
+        logger.info(f"Startup took {self._startup_time * 1000:.1f} ms")
+
+        if self._render_mode_override is not None:
+            self._render_mode = self._render_mode_override
+        self._idle_rendering: bool = self._render_mode == RENDER_MODE_IDLE
+        self._full_redraw: bool = True
+
+    def add_command(self, data: bytes, client=None):
+        """Queues a command for the next frame."""
+        self.metrics.commands += 1
+        self._command_batch.add(data, client)
+
+    def handle_profile(self, action: bytes):
+        """profile:start[:cprofile|:sample] and profile:stop:<path>"""
+        action, _, argument = action.decode(errors="replace").partition(":")
+        if action == "start":
+            mode: str = argument or MODE_DETERMINISTIC
+            if self._profiler is not None:
+                logger.error("Profiler is already running")
+            elif mode not in (MODE_DETERMINISTIC, MODE_SAMPLING):
+                logger.error(f"Unknown profile mode: {mode}")
+            else:
+                self._profiler = Profiler(mode, 1 / framerate)
+                self._profiler.start()
+        elif action == "stop":
+            if self._profiler is None:
+                logger.error("Profiler is not running")
+            elif not argument:
+                logger.error("profile:stop needs a path")
+            else:
+                profiler, self._profiler = self._profiler, None
+                try:
+                    profiler.stop(argument)
+                except OSError as err:
+                    logger.error(f"Could not write profile: {err}")
+        else:
+            logger.error(f"Unknown profile action: {action}")
 
-        clock = pg.time.Clock()
+    def read_shared_channel(self, command_batch: CommandBatch):
+        """Adds what the microphone wrote to the shared memory since the last
+        frame to the batch, like talk:start, talk:stop or level would."""
+        values: tuple = self._shared_channel.read()
+        if values is None:
+            return
+        talking, level = values
+        if level is None:
+            command_batch.talking = talking
+        elif math.isfinite(level):
+            command_batch.level = min(max(level, 0.0), 1.0)
+
+    def reply(self, client, data: bytes):
+        if self._control_server is not None:
+            self._control_server.reply(client, data)
+
+    def get_metrics_gauges(self) -> dict:
+        """Returns name: (help, value) of the gauges, can be called from any thread."""
+        gauges: dict = {
+            "states_bytes": ("Memory of the loaded states.", self._states.size),
+            "scale_cache_bytes": ("Memory of the scaled surface cache.", scaled_surface_cache.size),
+            "scale_cache_entries": ("Scaled images in the scaled surface cache.", len(scaled_surface_cache)),
+            "scale_cache_hits": ("Scaled images taken from the scaled surface cache.", scaled_surface_cache.hits),
+            "scale_cache_misses": ("Images scaled because they were not cached.", scaled_surface_cache.misses),
+        }
+        control_server: ControlServer = self._control_server
+        if control_server is not None:
+            gauges["command_queue_length"] = ("Commands waiting for the next frame.", len(control_server.commands))
+            gauges["dropped_commands"] = ("Commands dropped because the queue was full.", control_server.dropped)
+            gauges["clients"] = ("Connected clients.", len(control_server.clients))
+        return gauges
+
+    def get_client_stats(self) -> list:
+        if self._control_server is None:
+            return []
+        return self._control_server.get_client_stats()
+
+    def get_stats(self) -> dict:
+        stats: dict = self.metrics.to_dict(self.get_metrics_gauges(), self.get_client_stats())
+        stats["startup_seconds"] = self._startup_time
+        stats["assets"] = asset_loader.get_report()
+        return stats
+
+    def get_metrics_text(self) -> str:
+        return self.metrics.format_prometheus(self.get_metrics_gauges(), self.get_client_stats())
+
+    @property
+    def render_mode(self) -> str:
+        return self._render_mode
+
+    def get_state_count(self) -> int:
+        return len(self._states)
+
+    def get_memory_usage(self) -> dict:
+        """Returns the bytes used by the loaded states and the scale cache."""
+        return {"states": self._states.size, "scale_cache": scaled_surface_cache.size}
+
+    def stop(self):
+        if self._profiler is not None:
+            self._profiler.stop(time.strftime("pngtuber-%Y%m%d-%H%M%S.prof"))
+            self._profiler = None
+        if self._metrics_server is not None:
+            self._metrics_server.stop()
+        if self._file_watcher is not None:
+            self._file_watcher.stop()
+        if self._config_writer is not None:
+            self._config_writer.stop()
+        if self._shared_channel is not None:
+            self._shared_channel.close()
+        if self._control_server is not None:
+            self._control_server.stop()
+        logger.info(f"Scale cache: {scaled_surface_cache}")
+        smooth_scaler.shutdown()
+        asset_loader.shutdown()
+        # close pygame
+        pg.quit()
+
+    def render_frame(self, now: float) -> tuple:
+        """Applies the commands received since the last frame, runs the due
+        timers and draws the frame.
+
+        Returns the seconds spent applying commands, updating, drawing,
+        flipping and loading states in the background, and whether the state
+        changed.
+        """
+        perf_counter = time.perf_counter
+        start_time: float = perf_counter()
+        state_changed: bool = False
+        command_batch: CommandBatch = self._command_batch
+        if self._shared_channel is not None:
+            self.read_shared_channel(command_batch)
+        if command_batch:
+            if self.apply_commands(command_batch):
+                self._full_redraw = state_changed = True
+            command_batch.clear()
+        commands_time: float = perf_counter()
+        state_group: StateGroup = self._state_group
+        if smooth_scaler.collect():
+            state_group.refresh_scale()
+            self._states.refresh_size(self._active_state)
+            self._full_redraw = True
+        scheduler.run_due(now)
+        state_group.update()
+        update_time: float = perf_counter()
+        redrawn: bool = True
+        screen = self._screen
+        if self._idle_rendering:
+            dirty_rects = state_group.draw_dirty(screen, self._background_color, self._full_redraw)
+            self._full_redraw = False
+            draw_time: float = perf_counter()
+            if dirty_rects:
+                pg.display.update(dirty_rects)
+            else:
+                redrawn = False
+        else:
+            screen.fill(self._background_color)
+            try:
+                state_group.draw(screen)
+            except TypeError as err:
+                tb = traceback.format_exc()
+                logger.error(tb)
+            draw_time = perf_counter()
+            pg.display.flip()
+        flip_time: float = perf_counter()
+        if redrawn:
+            self._redraw_count += 1
+        if self._reloading:
+            self.swap_reloaded_states()
+        self._states.prefetch()
+        phases: tuple = (commands_time - start_time, update_time - commands_time,
+            draw_time - update_time, flip_time - draw_time, perf_counter() - flip_time)
+        self.metrics.observe_frame(phases, state_changed)
+        return phases + (state_changed,)
+
+    def loop(self):
+        self.start()
+        control_server: ControlServer = self._control_server
+        command_batch: CommandBatch = self._command_batch
+        metrics: Metrics = self.metrics
+        screen = self._screen
+
+        frame_interval: float = 1 / framerate
+        next_frame: float = time.monotonic()
+        self._redraw_count = 0
+        wakeup_count: int = 0
+        rate_start: float = next_frame
 
         # Main loop, run until window closed
         running = True
         while running:
-            # Get the list sockets which are readable
-            try:
-                inputready, outputready, exceptready = select.select(socket_list, [], [], 0.01)
-            except select.error:
-                break
-            except socket.error:
-                break
-
-            for s in inputready:
-                if s == server:
-                    # handle the server socket
-                    client, address = server.accept()
-                    logger.info(f"Got connection {client.fileno()} from {address}")
-                    socket_list.append(client)
-                elif s == sys.stdin:
-                    # handle standard input
-                    junk = sys.stdin.readline()
-                    running = 0
-                else:
-                    # handle all other sockets
-                    try:
-                        # data = s.recv(BUFSIZ)
-                        #data = s.recv(1024)
-                        data = self.get_next_command(s)
-                        if data is None:
-                            continue
-                        if data:
-                            if data == b"talk":
-                                png_tuber_state.talk()
-                            else:
-                                try:
-                                    cmd, body = data.split(b":", 1)
-                                    body = body.strip()
-                                    if cmd == b"state":
-                                        state_index = int(body)
-                                        if state_index < len(states):
-                                            png_tuber_state = states[state_index]
-                                            png_tuber_state.resize(s_width, s_height)
-                                        else:
-                                            logger.error("State index out of range")
-                                    else:
-                                        logger.error("Unknown cmd")
-                                except ValueError as err:
-                                    logger.error(err)
-                                    logger.error(f"data: {data}")
-                        else:
-                            logger.info(f"{s.fileno()} closed connection")
-                            s.close()
-                            del command_buffer[s]
-                            socket_list.remove(s)
-                    except (socket.error):
-                        # Remove
-                        del command_buffer[s]
-                        socket_list.remove(s)
+            now = time.monotonic()
+            deadline: float = next_frame
+            # the shared memory channel does not wake the loop up, it is read every frame
+            if (self._idle_rendering and not self._full_redraw and not command_batch
+                    and not smooth_scaler.ready and not self._reloading
+                    and self._shared_channel is None):
+                # sleep until the next timer or animation frame is due
+                deadline = now + MAX_IDLE_WAIT
+                next_timer = scheduler.get_next_deadline()
+                if next_timer is not None:
+                    deadline = min(deadline, next_timer)
+                next_update = self._state_group.get_next_update()
+                if next_update is not None:
+                    deadline = min(deadline, now + next_update)
+                deadline = max(deadline, next_frame)
+            # Wait for pygame events or commands, which wake the loop up by
+            # posting a COMMAND_EVENT, until the deadline at most
+            events: list = []
+            timeout: int = math.ceil((deadline - now) * 1000)
+            if timeout > 0:
+                event = pg.event.wait(timeout)
+                if event.type != pg.NOEVENT:
+                    events.append(event)
+            events.extend(pg.event.get())
+
+            socket_start: float = time.perf_counter()
+            for client, data in control_server.get_commands():
+                self.add_command(data, client)
 
             # Check events
-            for event in pg.event.get():
+            events_start: float = time.perf_counter()
+            for event in events:
                 logger.debug(f"Event type: {event.type}")
                 if event.type == pg.QUIT:
                     running = False
                 elif event.type == pg.VIDEORESIZE:
+                    resize_start: float = time.perf_counter()
                     self._s_width, self._s_height = screen.get_width(), screen.get_height()
                     s_width, s_height = self._s_width, self._s_height
-                    self._app_config["width"] = str(s_width)
-                    self._app_config["height"] = str(s_height)
-                    png_tuber_state.resize(s_width, s_height)
-                    self.save_config()
+                    self.save_setting("width", s_width)
+                    self.save_setting("height", s_height)
+                    self._state_group.resize(s_width, s_height)
+                    self.request_smooth_scale()
+                    metrics.resize.observe(time.perf_counter() - resize_start)
                     pg.display.update()
+                    self._full_redraw = True
                     #screen = pg.display.set_mode([s_width, s_height], pg.RESIZABLE)
+                elif event.type == RELOAD_EVENT:
+                    command_batch.reload = True
                 elif event.type == pg.VIDEOEXPOSE:
                     #png_tuber1.resize(s_width, s_height)
                     pg.display.update()
+                    self._full_redraw = True
                 elif event.type == pg.KEYUP:
                     key = event.key
                     if key in (pg.K_0, pg.K_1, pg.K_2, pg.K_2, pg.K_3, pg.K_4, pg.K_5, pg.K_6, pg.K_7, pg.K_8, pg.K_9):
                         logger.debug(f"Key pressed: {key}")
                         index = key - 48
                         logger.debug(f"index: {index}")
-                        if index < len(states):
-                            png_tuber_state = states[index]
-                            png_tuber_state.resize(s_width, s_height)
-            screen.fill(background_color)
-            png_tuber_state.update()
-            try:
-                png_tuber_state.draw(screen)
-            except TypeError as err:
-                tb = traceback.format_exc()
-                logger.error(tb)
-            pg.display.flip()
-            clock.tick(framerate)
-
-        # close pygame
-        pg.quit()
+                        command_batch.state = index
+            profiler: Profiler = self._profiler
+            if profiler is not None:
+                profiler.phases.add_input(events_start - socket_start, time.perf_counter() - events_start)
+            wakeup_count += 1
+            now = time.monotonic()
+            if now < next_frame:
+                # handled input before the next frame is due
+                continue
+            if now - deadline >= frame_interval:
+                # woke up one or more frames later than planned
+                metrics.missed_frames += int((now - deadline) / frame_interval)
+            next_frame = max(next_frame + frame_interval, now)
+            *phases, state_changed = self.render_frame(now)
+            # read again, the frame might have started or stopped the profiler
+            profiler = self._profiler
+            if profiler is not None:
+                profiler.phases.add_frame(phases)
+            if now - rate_start >= 1:
+                metrics.redraw_rate = self._redraw_count / (now - rate_start)
+                metrics.wakeup_rate = wakeup_count / (now - rate_start)
+                logger.debug(f"Redraw rate: {metrics.redraw_rate:.1f} fps, wakeups: {metrics.wakeup_rate:.1f}/s")
+                self._redraw_count = wakeup_count = 0
+                rate_start = now
+
+        self.stop()
 
 
 def main():
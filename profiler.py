@@ -0,0 +1,154 @@
+# Standard library imports.
+import sys
+import time
+import cProfile
+import threading
+import logging
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler(sys.stdout)
+#logger.setLevel(logging.DEBUG)
+formatter = logging.Formatter("%(name)s - %(levelname)s - %(message)s")
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+
+# Related third party imports.
+
+# Local application/library specific imports.
+from metrics import PHASES
+
+
+MODE_DETERMINISTIC: str = "cprofile"
+MODE_SAMPLING: str = "sample"
+SAMPLE_INTERVAL: float = 0.001
+# socket: taking the received commands from the control server
+# events: handling the pygame events, without waiting for them
+LOOP_PHASES: tuple = ("socket", "events") + PHASES
+PHASES_SUFFIX: str = ".phases.txt"
+
+
+class PhaseProfile:
+    """Time spent in each phase of the main loop while profiling.
+
+    A frame over the budget is blamed on its slowest phase.
+    """
+
+    def __init__(self, budget: float):
+        self.budget: float = budget
+        self.frames: int = 0
+        self.over_budget: int = 0
+        self.totals: list = [0.0] * len(LOOP_PHASES)
+        self.maxima: list = [0.0] * len(LOOP_PHASES)
+        self.blamed: list = [0] * len(LOOP_PHASES)
+        self._socket: float = 0
+        self._events: float = 0
+
+    def add_input(self, socket_time: float, events_time: float):
+        """Called for every wakeup of the loop, also without a frame."""
+        self._socket += socket_time
+        self._events += events_time
+
+    def add_frame(self, phases: tuple):
+        frame_phases: tuple = (self._socket, self._events) + tuple(phases)
+        self._socket = self._events = 0
+        self.frames += 1
+        totals, maxima = self.totals, self.maxima
+        for i, seconds in enumerate(frame_phases):
+            totals[i] += seconds
+            if seconds > maxima[i]:
+                maxima[i] = seconds
+        if sum(frame_phases) > self.budget:
+            self.over_budget += 1
+            self.blamed[frame_phases.index(max(frame_phases))] += 1
+
+    def format(self) -> str:
+        lines: list = [f"{self.frames} frames, {self.over_budget} over the budget of "
+            f"{self.budget * 1000:.1f} ms",
+            f"{'phase':<10} {'total ms':>10} {'mean ms':>9} {'max ms':>9} {'blamed':>7}"]
+        frames: int = max(self.frames, 1)
+        for phase, total, maximum, blamed in zip(LOOP_PHASES, self.totals, self.maxima, self.blamed):
+            lines.append(f"{phase:<10} {total * 1000:>10.2f} {total / frames * 1000:>9.3f} "
+                f"{maximum * 1000:>9.3f} {blamed:>7}")
+        return "\n".join(lines) + "\n"
+
+
+class SamplingProfiler:
+    """Samples the stack of a thread from a background thread and counts the
+    collapsed stacks, the format used by flame graph tools.
+
+    The sampler needs the GIL, so the switch interval of the interpreter is
+    lowered while sampling, otherwise code running longer than the default 5 ms
+    without releasing the GIL would hardly ever be sampled.
+    """
+
+    def __init__(self, thread_id: int, interval: float = SAMPLE_INTERVAL):
+        self._thread_id: int = thread_id
+        self._interval: float = interval
+        self._running: threading.Event = threading.Event()
+        self._thread: threading.Thread = None
+        self._switch_interval: float = None
+        self.stacks: dict = {}
+        self.samples: int = 0
+
+    def enable(self):
+        self._switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(min(self._switch_interval, self._interval / 2))
+        self._running.set()
+        self._thread = threading.Thread(target=self._run, name="SamplingProfiler", daemon=True)
+        self._thread.start()
+
+    def disable(self):
+        self._running.clear()
+        self._thread.join()
+        sys.setswitchinterval(self._switch_interval)
+
+    def _run(self):
+        stacks: dict = self.stacks
+        while self._running.is_set():
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is not None:
+                names: list = []
+                while frame is not None:
+                    code = frame.f_code
+                    names.append(f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack: str = ";".join(reversed(names))
+                stacks[stack] = stacks.get(stack, 0) + 1
+                self.samples += 1
+            time.sleep(self._interval)
+
+    def dump(self, path: str):
+        with open(path, "w", encoding="utf-8") as stacks_fh:
+            for stack, count in self.stacks.items():
+                stacks_fh.write(f"{stack} {count}\n")
+
+
+class Profiler:
+    """Profiles the main loop from profile:start until profile:stop:<path>.
+
+    cprofile writes pstats to path, sample writes collapsed stacks. The time of
+    the loop phases is written to path + .phases.txt in both modes.
+    """
+
+    def __init__(self, mode: str, budget: float):
+        self.mode: str = mode
+        self.phases: PhaseProfile = PhaseProfile(budget)
+        if mode == MODE_SAMPLING:
+            self._profiler = SamplingProfiler(threading.get_ident())
+        else:
+            self._profiler = cProfile.Profile()
+
+    def start(self):
+        logger.info(f"Profiling with {self.mode}")
+        self._profiler.enable()
+
+    def stop(self, path: str):
+        self._profiler.disable()
+        if self.mode == MODE_SAMPLING:
+            self._profiler.dump(path)
+        else:
+            self._profiler.dump_stats(path)
+        phases_path: str = path + PHASES_SUFFIX
+        report: str = self.phases.format()
+        with open(phases_path, "w", encoding="utf-8") as phases_fh:
+            phases_fh.write(report)
+        logger.info(f"Wrote profile to {path} and {phases_path}\n{report}")
@@ -0,0 +1,108 @@
+# Standard library imports.
+import sys
+import socket
+import logging
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler(sys.stdout)
+#logger.setLevel(logging.DEBUG)
+formatter = logging.Formatter("%(name)s - %(levelname)s - %(message)s")
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+
+# Related third party imports.
+
+# Local application/library specific imports.
+
+
+DELIMITER: bytes = b"\r\n"
+MAX_LINE_LENGTH: int = 4096
+RECV_SIZE: int = 65536
+
+DEFAULT_HOST: str = "localhost"
+DEFAULT_PORT: int = 8089
+DEFAULT_UNIX_SOCKET: str = "/tmp/pngtuber.sock"
+TRANSPORT_TCP: str = "tcp"
+TRANSPORT_UNIX: str = "unix"
+TRANSPORT_UDP: str = "udp"
+
+
+class LineReader:
+    """Splits a byte stream into commands terminated by \r\n.
+
+    Every call of feed() returns all commands which are complete, the rest is
+    kept until more data arrives. Lines longer than max_line_length are dropped.
+    """
+
+    def __init__(self, max_line_length: int = MAX_LINE_LENGTH):
+        self._buffer: bytearray = bytearray()
+        self._discarding: bool = False
+        self.max_line_length: int = max_line_length
+        self.dropped: int = 0
+
+    def __len__(self) -> int:
+        return len(self._buffer)
+
+    def feed(self, data: bytes) -> list:
+        buffer = self._buffer
+        # the delimiter might have been split between two chunks
+        start: int = max(len(buffer) - 1, 0)
+        buffer += data
+        find = buffer.find
+        max_line_length: int = self.max_line_length
+        lines: list = []
+        line_start: int = 0
+        pos: int = find(DELIMITER, start)
+        while pos != -1:
+            if self._discarding:
+                self._discarding = False
+            elif pos - line_start > max_line_length:
+                self.dropped += 1
+                logger.error(f"Dropping command, longer than {max_line_length} bytes")
+            else:
+                lines.append(bytes(buffer[line_start:pos]))
+            line_start = pos + 2
+            pos = find(DELIMITER, line_start)
+        del buffer[:line_start]
+        # a trailing \r is not part of the command
+        if len(buffer) - buffer.endswith(b"\r") > max_line_length:
+            # keep a trailing \r, it might be the first half of the delimiter
+            if not self._discarding:
+                self.dropped += 1
+                logger.error(f"Dropping command, longer than {max_line_length} bytes")
+            self._discarding = True
+            del buffer[:-1]
+        return lines
+
+
+def get_connection_name(app_config) -> str:
+    transport: str = app_config.get("transport", TRANSPORT_TCP)
+    host: str = app_config.get("host", DEFAULT_HOST)
+    port = app_config.get("port", DEFAULT_PORT)
+    if transport == TRANSPORT_UNIX:
+        return app_config.get("unix_socket", DEFAULT_UNIX_SOCKET)
+    elif transport == TRANSPORT_UDP:
+        return f"udp://{host}:{app_config.get('udp_port', port)}"
+    return f"{host}:{port}"
+
+
+def create_connection(app_config, timeout: float = None) -> socket.socket:
+    """Returns a socket connected to PNGTuber, using the transport configured in
+    the [app] section of a client: tcp (default), unix or udp."""
+    transport: str = app_config.get("transport", TRANSPORT_TCP)
+    host: str = app_config.get("host", DEFAULT_HOST)
+    port: int = int(app_config.get("port", DEFAULT_PORT))
+    if transport == TRANSPORT_UNIX:
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.settimeout(timeout)
+        try:
+            s.connect(app_config.get("unix_socket", DEFAULT_UNIX_SOCKET))
+        except OSError:
+            s.close()
+            raise
+        return s
+    elif transport == TRANSPORT_UDP:
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.settimeout(timeout)
+        s.connect((host, int(app_config.get("udp_port", port))))
+        return s
+    return socket.create_connection((host, port), timeout)
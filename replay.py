@@ -0,0 +1,140 @@
+# Standard library imports.
+import sys
+import time
+import random
+import argparse
+import logging
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler(sys.stdout)
+#logger.setLevel(logging.DEBUG)
+formatter = logging.Formatter("%(name)s - %(levelname)s - %(message)s")
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+
+# Related third party imports.
+
+# Local application/library specific imports.
+from command_trace import read_trace, COMMENT, SEPARATOR
+from protocol import create_connection, get_connection_name, DELIMITER, DEFAULT_HOST, DEFAULT_PORT, \
+    DEFAULT_UNIX_SOCKET, TRANSPORT_TCP, TRANSPORT_UNIX, TRANSPORT_UDP
+
+# Replays a recorded command trace against a running PNGTuber, or generates
+# load at a fixed rate:
+#
+#   python replay.py trace.txt [--speed 2] [--connections 10]
+#   python replay.py --rate 1000 --duration 10 --connections 50 [--state-ratio 0.05]
+#   python replay.py --rate 1000 --duration 10 --write synthetic.txt
+#
+# The commands are distributed round robin over the connections. A trace can be
+# recorded by setting trace_file in the [app] section of config.ini, a written
+# trace can be rendered with benchmark.py to see how the input rate affects the
+# frame pacing.
+
+DEFAULT_DURATION: float = 10
+DEFAULT_STATES: int = 2
+DEFAULT_STATE_RATIO: float = 0.05
+
+
+def synthesize_trace(rate: float, duration: float, state_ratio: float, states: int, seed: int = 0) -> list:
+    """Returns talk commands at a fixed rate, state_ratio of them are replaced
+    by switches to a random state."""
+    rng = random.Random(seed)
+    trace: list = []
+    interval: float = 1 / rate
+    for i in range(int(rate * duration)):
+        if rng.random() < state_ratio:
+            command = b"state:%d" % rng.randrange(states)
+        else:
+            command = b"talk"
+        trace.append((i * interval, command))
+    return trace
+
+
+def write_trace(path: str, trace: list):
+    with open(path, "w", encoding="utf-8", newline="\n") as trace_fh:
+        trace_fh.write(f"{COMMENT} synthesized {len(trace)} commands\n")
+        for seconds, command in trace:
+            trace_fh.write(f"{seconds:.6f}{SEPARATOR}{command.decode()}\n")
+
+
+def replay(app_config, trace: list, connections: int, speed: float) -> dict:
+    """Sends the commands of the trace at their time, divided by speed.
+
+    Commands which are due at the same time are sent to a connection in one
+    write. Returns the number of sent commands and how far the sender fell
+    behind the trace.
+    """
+    sockets: list = [create_connection(app_config) for _ in range(connections)]
+    logger.info(f"Opened {connections} connections to {get_connection_name(app_config)}")
+    pending: list = [[] for _ in range(connections)]
+    max_lag: float = 0
+    sent: int = 0
+    start_time: float = time.monotonic()
+    try:
+        i: int = 0
+        while i < len(trace):
+            due: float = start_time + trace[i][0] / speed
+            delay: float = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                max_lag = max(max_lag, -delay)
+            # everything that is due by now
+            now: float = time.monotonic()
+            while i < len(trace) and start_time + trace[i][0] / speed <= now:
+                pending[i % connections].append(trace[i][1] + DELIMITER)
+                i += 1
+            for s, commands in zip(sockets, pending):
+                if commands:
+                    s.sendall(b"".join(commands))
+                    sent += len(commands)
+                    commands.clear()
+    finally:
+        elapsed: float = time.monotonic() - start_time
+        for s in sockets:
+            s.close()
+    return {"sent": sent, "elapsed": elapsed, "max_lag": max_lag}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replays a command trace or generates load against PNGTuber.")
+    parser.add_argument("trace", nargs="?", help="trace to replay, <seconds>\\t<command> per line")
+    parser.add_argument("--rate", type=float, help="synthesize this many commands per second instead")
+    parser.add_argument("--duration", type=float, default=DEFAULT_DURATION,
+        help="seconds of synthesized commands")
+    parser.add_argument("--state-ratio", type=float, default=DEFAULT_STATE_RATIO,
+        help="share of synthesized commands which switch the state")
+    parser.add_argument("--states", type=int, default=DEFAULT_STATES,
+        help="number of states the synthesized state commands choose from")
+    parser.add_argument("--write", help="write the synthesized trace to this file instead of sending it")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed factor")
+    parser.add_argument("--connections", type=int, default=1, help="number of concurrent connections")
+    parser.add_argument("--transport", default=TRANSPORT_TCP,
+        choices=(TRANSPORT_TCP, TRANSPORT_UNIX, TRANSPORT_UDP))
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--unix-socket", default=DEFAULT_UNIX_SOCKET)
+    parser.add_argument("--udp-port", type=int)
+    args = parser.parse_args()
+
+    if args.rate:
+        trace = synthesize_trace(args.rate, args.duration, args.state_ratio, args.states)
+    elif args.trace:
+        trace = read_trace(args.trace)
+    else:
+        parser.error("either a trace or --rate is required")
+    if args.write:
+        write_trace(args.write, trace)
+        logger.info(f"Wrote {len(trace)} commands to {args.write}")
+        return
+
+    app_config: dict = {"transport": args.transport, "host": args.host, "port": args.port,
+        "unix_socket": args.unix_socket, "udp_port": args.udp_port or args.port}
+    result = replay(app_config, trace, max(args.connections, 1), args.speed)
+    print(f"sent {result['sent']} commands in {result['elapsed']:.2f} s "
+        f"({result['sent'] / max(result['elapsed'], 1e-9):,.0f} commands/s), "
+        f"max lag {result['max_lag'] * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
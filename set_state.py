@@ -1,28 +1,95 @@
 # Standard library imports.
+import os
 import sys
-import socket
+import stat
+import argparse
 import configparser
+import logging
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler(sys.stdout)
+#logger.setLevel(logging.DEBUG)
+formatter = logging.Formatter("%(name)s - %(levelname)s - %(message)s")
+handler.setFormatter(formatter)
+logger.addHandler(handler)
 
 # Related third party imports.
 
 # Local application/library specific imports.
+from client import Client
 
-state = sys.argv[1]
-
-config = configparser.ConfigParser()
-config.read('states.ini')
-try:
-    app_config = config["app"]
-except KeyError:
-    app_config = config["app"] = {
-        "hostname": "localhost",
-        "port": 8089
-    }
-
-host = app_config.get("host", "localhost")
-port = int(app_config.get("port", 8089))
-
-s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-s.connect((host, port))
-s.send(f"state:{state}\r\n".encode("utf-8"))
-s.close()
+# Selects a state of PNGTuber by number or name:
+#
+#   python set_state.py scared
+#
+# In daemon mode the connection stays open and every line read from stdin, or
+# from a named pipe, selects a state, so shell scripts do not connect per call:
+#
+#   python set_state.py --daemon --fifo /tmp/pngtuber-state &
+#   echo scared > /tmp/pngtuber-state
+
+# seconds a single state waits for the connection before it is given up
+STOP_TIMEOUT: float = 2.0
+
+
+def load_app_config():
+    config = configparser.ConfigParser()
+    config.read('states.ini')
+    try:
+        return config["app"]
+    except KeyError:
+        return {"hostname": "localhost", "port": 8089}
+
+
+def send_states(lines, client: Client):
+    for line in lines:
+        state: str = line.strip()
+        if state:
+            client.send(f"state:{state}")
+
+
+def serve_fifo(path: str, client: Client):
+    if not os.path.exists(path):
+        os.mkfifo(path)
+    elif not stat.S_ISFIFO(os.stat(path).st_mode):
+        # a regular file would be read again and again
+        raise ValueError(f"{path} is not a named pipe")
+    while True:
+        # blocks until a writer opens the pipe, ends when the last writer closes it
+        with open(path, encoding="utf-8") as fifo_fh:
+            send_states(fifo_fh, client)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Selects a state of PNGTuber.")
+    parser.add_argument("state", nargs="?", help="number or name of the state")
+    parser.add_argument("--daemon", action="store_true",
+        help="keep the connection open and read one state per line from stdin")
+    parser.add_argument("--fifo", help="read the states from this named pipe instead of stdin")
+    args = parser.parse_args()
+    if not args.daemon and args.state is None:
+        parser.error("either a state or --daemon is required")
+
+    client = Client(load_app_config())
+    client.start()
+    try:
+        if not args.daemon:
+            client.send(f"state:{args.state}")
+        elif args.fifo:
+            try:
+                serve_fifo(args.fifo, client)
+            except (OSError, ValueError) as err:
+                logger.error(f"Could not read {args.fifo}: {err}")
+                sys.exit(1)
+        else:
+            send_states(sys.stdin, client)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        client.stop(STOP_TIMEOUT)
+    if not args.daemon and client.sent == 0:
+        logger.error("Could not connect to PNGTuber")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+# Standard library imports.
+import sys
+import time
+import struct
+import logging
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler(sys.stdout)
+#logger.setLevel(logging.DEBUG)
+formatter = logging.Formatter("%(name)s - %(levelname)s - %(message)s")
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+
+try:
+    from multiprocessing import shared_memory
+    from multiprocessing import resource_tracker
+except ImportError:
+    # not available on some platforms
+    shared_memory = None
+
+# Related third party imports.
+
+# Local application/library specific imports.
+
+
+# The microphone writes the talk state and the mouth level, the renderer reads
+# them once per frame. Both are guarded by a sequence number, which is odd
+# while the microphone is writing, so the renderer never applies a half
+# written value and can tell from the sequence number alone whether anything
+# changed. The renderer counts the heartbeat up every frame, so the microphone
+# notices when it is gone and falls back to the socket.
+#
+#   sequence   uint32, written by the microphone
+#   level      float32, 0..1, only valid with FLAG_LEVEL
+#   flags      uint8
+#   heartbeat  uint32, written by the renderer
+MAGIC: bytes = b"PNGS"
+HEADER = struct.Struct("<4s")
+SEQUENCE = struct.Struct("<I")
+VALUES = struct.Struct("<IfB")
+HEARTBEAT = struct.Struct("<I")
+SEQUENCE_OFFSET: int = HEADER.size
+HEARTBEAT_OFFSET: int = 16
+SIZE: int = HEARTBEAT_OFFSET + HEARTBEAT.size
+FLAG_TALKING: int = 1
+FLAG_LEVEL: int = 2
+# a read gives up after this many attempts and tries again next frame
+MAX_READ_ATTEMPTS: int = 4
+# seconds without a heartbeat after which the renderer is considered gone
+HEARTBEAT_TIMEOUT: float = 1.0
+
+
+class SharedChannel:
+    """Talk state and mouth level in a named shared memory block, an optional
+    fast path between microphone.py and pngtuber.py on the same machine.
+
+    The renderer creates the block with create() and removes it on close(),
+    the microphone attaches to it with attach(). Reading and writing are a
+    few struct operations on the mapped memory, without system calls.
+    """
+
+    def __init__(self, shm, owner: bool):
+        self._shm = shm
+        self._buf = shm.buf
+        self._owner: bool = owner
+        self._sequence: int = 0
+        self._last_sequence: int = None
+        self._heartbeat: int = 0
+        self._last_heartbeat: int = None
+        self._heartbeat_time: float = 0
+        # the heartbeat changed since attach()
+        self.confirmed: bool = False
+
+    @classmethod
+    def create(cls, name: str) -> "SharedChannel":
+        """Creates the block, or takes over the one left behind by a crash."""
+        if shared_memory is None:
+            raise OSError("multiprocessing.shared_memory is not available")
+        try:
+            shm = shared_memory.SharedMemory(name, create=True, size=SIZE)
+        except FileExistsError:
+            shm = shared_memory.SharedMemory(name)
+            if shm.size < SIZE:
+                shm.close()
+                raise OSError(f"shared memory {name} is too small")
+        shm.buf[:SIZE] = bytes(SIZE)
+        HEADER.pack_into(shm.buf, 0, MAGIC)
+        logger.info(f"Created shared memory {name}")
+        channel = cls(shm, True)
+        channel._last_sequence = 0
+        return channel
+
+    @classmethod
+    def attach(cls, name: str) -> "SharedChannel":
+        """Attaches to the block of a running renderer, raises OSError if there is none."""
+        if shared_memory is None:
+            raise OSError("multiprocessing.shared_memory is not available")
+        shm = shared_memory.SharedMemory(name)
+        try:
+            # the block belongs to the renderer, the resource tracker would
+            # remove it when this process exits
+            resource_tracker.unregister(shm._name, "shared_memory")
+        except (AttributeError, KeyError, ValueError):
+            pass
+        if shm.size < SIZE or HEADER.unpack_from(shm.buf)[0] != MAGIC:
+            shm.close()
+            raise OSError(f"shared memory {name} is not a PNGTuber channel")
+        channel = cls(shm, False)
+        channel._sequence = SEQUENCE.unpack_from(shm.buf, SEQUENCE_OFFSET)[0] & ~1
+        # a block left behind by a crashed renderer is attached as well, it is
+        # only confirmed once the heartbeat changes
+        channel._last_heartbeat = HEARTBEAT.unpack_from(shm.buf, HEARTBEAT_OFFSET)[0]
+        channel._heartbeat_time = time.monotonic()
+        return channel
+
+    def write(self, talking: bool, level: float = None):
+        """Publishes the talk state and, in level mode, the mouth level."""
+        buf = self._buf
+        # odd while writing
+        writing: int = (self._sequence + 1) & 0xFFFFFFFF
+        SEQUENCE.pack_into(buf, SEQUENCE_OFFSET, writing)
+        flags: int = FLAG_TALKING if talking else 0
+        if level is not None:
+            flags |= FLAG_LEVEL
+        VALUES.pack_into(buf, SEQUENCE_OFFSET, writing, level or 0.0, flags)
+        self._sequence = (writing + 1) & 0xFFFFFFFF
+        SEQUENCE.pack_into(buf, SEQUENCE_OFFSET, self._sequence)
+
+    def read(self) -> tuple:
+        """Returns (talking, level) if the microphone wrote since the last
+        read, else None. level is None in talk mode. Counts the heartbeat up."""
+        buf = self._buf
+        self._heartbeat = (self._heartbeat + 1) & 0xFFFFFFFF
+        HEARTBEAT.pack_into(buf, HEARTBEAT_OFFSET, self._heartbeat)
+        for _ in range(MAX_READ_ATTEMPTS):
+            sequence: int = SEQUENCE.unpack_from(buf, SEQUENCE_OFFSET)[0]
+            if sequence == self._last_sequence:
+                return None
+            if sequence & 1:
+                continue
+            _, level, flags = VALUES.unpack_from(buf, SEQUENCE_OFFSET)
+            if SEQUENCE.unpack_from(buf, SEQUENCE_OFFSET)[0] != sequence:
+                continue
+            self._last_sequence = sequence
+            return bool(flags & FLAG_TALKING), level if flags & FLAG_LEVEL else None
+        return None
+
+    def is_renderer_alive(self, now: float = None) -> bool:
+        """False once the heartbeat did not change for HEARTBEAT_TIMEOUT."""
+        if now is None:
+            now = time.monotonic()
+        heartbeat: int = HEARTBEAT.unpack_from(self._buf, HEARTBEAT_OFFSET)[0]
+        if heartbeat != self._last_heartbeat:
+            self._last_heartbeat = heartbeat
+            self._heartbeat_time = now
+            self.confirmed = True
+            return True
+        return now - self._heartbeat_time < HEARTBEAT_TIMEOUT
+
+    def close(self):
+        self._buf = None
+        self._shm.close()
+        if self._owner:
+            try:
+                self._shm.unlink()
+            except OSError:
+                pass
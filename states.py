@@ -1,5 +1,5 @@
 import sys
-import socket
+import json
 import configparser
 #import logging
 #logger = logging.getLogger(__name__)
@@ -8,6 +8,9 @@ from tkinter import *
 from tkinter import ttk
 from tkinter.simpledialog import Dialog
 
+from protocol import get_connection_name
+from client import Client
+
 # lbl -> label
 # frm -> frame
 # cbx -> combobox
@@ -17,21 +20,31 @@ from tkinter.simpledialog import Dialog
 class States(Tk):
 
     stream = None
-    connected: bool = False
-    _last_state: bytes = None
     _last_entry: int = 0
     _host: str = "localhost"
     _port: int = 8089
-  
-    def connect(self):
+    # names received with the answer to list, shown by update_gui
+    _received_states: list = None
+
+    def on_connect(self):
+        # ask PNGTuber for the names of its states, until it answers the ones
+        # read from config.ini are shown
+        self.client.send(b"list")
+
+    def on_reply(self, line: bytes):
+        if not line.startswith(b"list:"):
+            return
         try:
-            self._s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self._s.connect((self._host, self._port))
-            self.connected = True
-            self.cvs_status.itemconfig(self.status, fill='green')
-        except:
-            self.connected = False
-            self.cvs_status.itemconfig(self.status, fill='red')
+            state_list = json.loads(line[5:])
+            self._received_states = [state["name"] for state in state_list["states"]]
+        except (ValueError, KeyError, TypeError):
+            print(f"invalid list answer: {line!r}")
+
+    def set_states(self, states: list):
+        current = self.cbx_states.get()
+        self.cbx_states['values'] = states
+        if current in states:
+            self.cbx_states.current(states.index(current))
 
     def load_pngtuber_config(self):
         config = configparser.ConfigParser()
@@ -44,7 +57,7 @@ class States(Tk):
             print(f"loading {state_name} ...")
             states.append(state_name)
             state = config[state_name]
-        self.cbx_states['values'] = states
+        self.set_states(states)
 
     def load_config(self):
         self._config = config = configparser.ConfigParser()
@@ -59,8 +72,17 @@ class States(Tk):
             }
         self._host = app_config.get("host", "localhost")
         self._port = int(app_config.get("port", 8089))
-        self._last_entry = int(app_config.get("last_state",0 ))
-        self.cbx_states.current(self._last_entry)
+        last_state = app_config.get("last_state", "")
+        states = list(self.cbx_states['values'])
+        self._last_entry = 0
+        # by name, older files hold the position in the list
+        if last_state in states:
+            self._last_entry = states.index(last_state)
+        elif last_state.isdigit() and int(last_state) < len(states):
+            self._last_entry = int(last_state)
+        self._app_config = app_config
+        if states:
+            self.cbx_states.current(self._last_entry)
 
     def __init__(self):
         super().__init__()
@@ -90,7 +112,9 @@ class States(Tk):
         self.cbx_states.pack(side=LEFT, padx=padding, pady=padding)
         self.load_pngtuber_config()
         self.load_config()
-        self.lbl_connection['text'] = f"{self._host}:{self._port}"
+        self.lbl_connection['text'] = get_connection_name(self._app_config)
+        self.client = Client(self._app_config, on_reply=self.on_reply, on_connect=self.on_connect)
+        self.client.start()
         # vvvv - set state button
         self.set_state_button = ttk.Button(frm_state,
             text='set state', command=self.on_set_state)
@@ -134,41 +158,46 @@ class States(Tk):
         self.update_gui()
 
     def on_set_state(self, *args):
-        state = self.cbx_states.current()
-        try:
-            last_state = self._last_state = f"state:{state}\r\n".encode()
-            self._s.send(last_state)
-        except (BrokenPipeError, ConnectionResetError):
-            self.connected = False
+        # by name, the position of a state in config.ini might change
+        state = self.cbx_states.get()
+        if not state:
+            return
+        # queued until the connection is back, only the last state is kept
+        self.client.send(f"state:{state}")
+
     def on_settings(self, *args):
         w = SettingsWindow(self, 'Settings')
         if w.result is not None:
             self.create_stream(device=w.result)
 
     def on_save(self, *args):
-        self._config["app"] = {
+        # keep the transport settings
+        self._config["app"] = dict(self._app_config, **{
             "host": self._host,
             "port": self._port,
-            "last_state": self.cbx_states.current(),
-        }
+            "last_state": self.cbx_states.get(),
+        })
         with open('states.ini', 'w') as configfile:
             self._config.write(configfile)
 
     def on_reload(self, *args):
-        self._s.close()
         self.load_pngtuber_config()
         self.load_config()
+        self.lbl_connection['text'] = get_connection_name(self._app_config)
+        # connects again, the list is requested after the reload was applied
+        self.client.reconfigure(self._app_config)
+        # let PNGTuber pick up the changes of config.ini and layers.ini
+        self.client.send(b"reload")
 
     def update_gui(self):
-        if not self.connected:
-            self.connect()
-            if self._last_state is not None:
-                self._s.send(self._last_state)
-                self._last_state = None
+        self.cvs_status.itemconfig(self.status, fill='green' if self.client.connected else 'red')
+        if self._received_states is not None:
+            self.set_states(self._received_states)
+            self._received_states = None
         self.after(100, self.update_gui)
 
     def close_window(self):
-        self._s.close()
+        self.client.stop()
         self.destroy()
 
 